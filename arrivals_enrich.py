@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+"""
+Static GTFS details for realtime arrivals (`?enrich=1`).
+
+Built once from gtfs_subway/stops.txt, trips.txt and routes.txt (parsed by
+static_gtfs.py) into plain dicts, so enriching an arrival is a few dict
+lookups and never touches the database:
+
+    stop_id          -> stop_name
+    route_id         -> (route_color, route_text_color)
+    realtime trip_id -> (trip_headsign, direction_id)
+
+Static trip_ids look like "BFA25GEN-A087-Weekday-00_132600_A..S58R"; the
+realtime feed uses the part after the first "_" ("132600_A..S58R"). About
+half the realtime trips have no static counterpart (supplemented or
+rerouted service). Those get direction_id from the N/S after "..", and as
+headsign the name of the last stop in their realtime trip update (the
+feed's terminal), or failing that the headsign every static trip of that
+route and direction shares.
+"""
+import threading
+from collections import Counter
+
+import static_gtfs
+
+_INDEX = None
+_INDEX_LOCK = threading.Lock()
+
+_DIRECTIONS = {"N": 0, "S": 1}  # NYCT trip_id direction letter -> direction_id
+
+
+def _trip_key(trip_id):
+    """(route_id, direction letter) from "132600_A..S58R", or None."""
+    _, _, rest = trip_id.partition("_")
+    route_id, sep, path = rest.partition("..")
+    if not sep or not path:
+        return None
+    return route_id, path[0]
+
+
+def build_index(gtfs_dir=static_gtfs.GTFS_DIR):
+    # Not stop_times / shapes: by far the largest files, and not needed here.
+    tables = static_gtfs.load_from_files(gtfs_dir, tables=("stops", "routes", "trips"))
+
+    stops = {row["stop_id"]: row["stop_name"] for row in tables["stops"].rows()}
+    routes = {
+        row["route_id"]: (row["route_color"], row["route_text_color"])
+        for row in tables["routes"].rows()
+    }
+
+    trips = {}
+    by_direction = {}
+    for row in tables["trips"].rows():
+        realtime_id = row["trip_id"].partition("_")[2]
+        details = (row["trip_headsign"], row["direction_id"])
+        trips[realtime_id] = details
+
+        key = _trip_key(realtime_id)
+        if key is not None:
+            by_direction.setdefault((row["route_id"], key[1]), Counter())[details] += 1
+
+    # Only fall back to a headsign every static trip of the direction shares.
+    directions = {}
+    for (route_id, letter), counts in by_direction.items():
+        headsign = None
+        if len({headsign for headsign, _ in counts}) == 1:
+            headsign = next(iter(counts))[0]
+        directions[(route_id, letter)] = (headsign, _DIRECTIONS.get(letter))
+
+    return {"stops": stops, "routes": routes, "trips": trips, "directions": directions}
+
+
+def load():
+    """Build the index if it is not built yet (call at startup)."""
+    global _INDEX
+    with _INDEX_LOCK:
+        if _INDEX is None:
+            _INDEX = build_index()
+        return _INDEX
+
+
+def _trip_details(index, route_id, trip_id, terminal):
+    details = index["trips"].get(trip_id)
+    if details is not None:
+        return details
+
+    key = _trip_key(trip_id)
+    headsign, direction_id = None, None
+    if key is not None:
+        headsign, direction_id = index["directions"].get(
+            (route_id, key[1]), (None, _DIRECTIONS.get(key[1]))
+        )
+    terminal_name = index["stops"].get(terminal)
+    return terminal_name or headsign, direction_id
+
+
+def enrich(arrivals, route_id, terminals=None):
+    """
+    Add stop_name, trip_headsign, direction_id and route colors in place.
+    `terminals` is trip_id -> last stop_id in the realtime feed.
+    """
+    terminals = terminals or {}
+    index = _INDEX or load()
+    route_color, route_text_color = index["routes"].get(route_id, (None, None))
+    stops = index["stops"]
+
+    trips = {}
+    for arrival in arrivals:
+        trip_id = arrival["trip_id"]
+        details = trips.get(trip_id)
+        if details is None:
+            details = trips[trip_id] = _trip_details(
+                index, route_id, trip_id, terminals.get(trip_id)
+            )
+
+        arrival["stop_name"] = stops.get(arrival["stop_id"])
+        arrival["trip_headsign"], arrival["direction_id"] = details
+        arrival["route_color"] = route_color
+        arrival["route_text_color"] = route_text_color
+    return arrivals
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+Server-Sent Events for /route/<route_id>/arrivals/stream.
+
+A subscriber first gets a `snapshot` event carrying the same JSON as
+/route/<route_id>/arrivals. After that it gets a `diff` event each time the
+underlying feed changes:
+
+    event: diff
+    id: <feed header timestamp>
+    data: {"version": ..., "added": [...], "changed": [...], "removed": [...]}
+
+`added` / `changed` hold arrivals in the usual shape; `removed` holds
+{"trip_id", "stop_id"} pairs. Events are encoded once per
+(route, stops, from-version, to-version) and shared by every subscriber on
+that transition, so one refresh fans out to N clients without N
+recomputations.
+"""
+import json
+import time
+import threading
+
+from collections import OrderedDict
+
+import feed_cache
+
+PING_INTERVAL = 15   # seconds between keep-alive comments on an idle stream
+EVENT_CACHE_SIZE = 256
+
+# (route_id, stop_ids, from_version, to_version) -> encoded SSE event
+_EVENT_CACHE = OrderedDict()
+_EVENT_CACHE_LOCK = threading.Lock()
+
+PING = b": ping\n\n"
+
+
+def _event(name, version, payload):
+    return f"event: {name}\nid: {version}\ndata: ".encode() + payload + b"\n\n"
+
+
+def _by_key(entry, route_id, stop_ids):
+    return {
+        (a["trip_id"], a["stop_id"]): a
+        for a in feed_cache.entry_arrivals(entry, route_id, stop_ids)
+    }
+
+
+def snapshot_event(entry, route_id, stop_ids):
+    body, version = feed_cache.arrivals_json(entry, route_id, stop_ids)
+    return _event("snapshot", version, body)
+
+
+def diff_event(old_entry, new_entry, route_id, stop_ids):
+    """
+    Encoded `diff` event from `old_entry` to `new_entry`, or None when the
+    arrivals for this route/stops did not change.
+    """
+    stops = tuple(sorted(set(stop_ids or ())))
+    key = (route_id, stops, old_entry["version"], new_entry["version"])
+
+    with _EVENT_CACHE_LOCK:
+        if key in _EVENT_CACHE:
+            _EVENT_CACHE.move_to_end(key)
+            return _EVENT_CACHE[key]
+
+    old = _by_key(old_entry, route_id, stops)
+    new = _by_key(new_entry, route_id, stops)
+
+    added = [a for k, a in new.items() if k not in old]
+    changed = [
+        a for k, a in new.items()
+        if k in old and old[k]["arrival_epoch"] != a["arrival_epoch"]
+    ]
+    removed = [{"trip_id": t, "stop_id": s} for (t, s) in old if (t, s) not in new]
+
+    if added or changed or removed:
+        payload = json.dumps(
+            {
+                "version": new_entry["version"],
+                "added": added,
+                "changed": changed,
+                "removed": removed,
+            },
+            sort_keys=True,
+            separators=(",", ":"),
+        ).encode()
+        event = _event("diff", new_entry["version"], payload)
+    else:
+        event = None
+
+    with _EVENT_CACHE_LOCK:
+        _EVENT_CACHE[key] = event
+        while len(_EVENT_CACHE) > EVENT_CACHE_SIZE:
+            _EVENT_CACHE.popitem(last=False)
+    return event
+
+
+def stream(url, route_id, stop_ids):
+    """Blocking SSE generator for the threaded (Flask) servers."""
+    entry = feed_cache.get_entry(url)
+    yield snapshot_event(entry, route_id, stop_ids)
+    last_sent = time.monotonic()
+
+    while True:
+        # Ping after PING_INTERVAL without an event, including when the feed
+        # changes but not for these stops.
+        wait = max(PING_INTERVAL - (time.monotonic() - last_sent), 0)
+        latest = feed_cache.wait_for_update(url, entry["version"], wait)
+        if latest["version"] != entry["version"]:
+            event = diff_event(entry, latest, route_id, stop_ids)
+            entry = latest
+            if event is not None:
+                yield event
+                last_sent = time.monotonic()
+                continue
+
+        if time.monotonic() - last_sent >= PING_INTERVAL:
+            yield PING
+            last_sent = time.monotonic()
@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the /route/<route_id>/arrivals lookup against a captured
+feed, without Flask or the network.
+
+Usage:
+    python3 bench_arrivals.py [feed.bin] [route_id] [stop_id ...]
+"""
+import sys
+import json
+import timeit
+
+import arrivals_enrich
+
+import feed_cache
+
+
+def scan_arrivals(feed, route_id, stop_filter):
+    """The original per-request walk over the whole feed."""
+    arrivals = []
+    for ent in feed.entity:
+        if not ent.HasField("trip_update"):
+            continue
+
+        trip = ent.trip_update.trip
+        if trip.route_id != route_id:
+            continue
+
+        for stu in ent.trip_update.stop_time_update:
+            if not stu.HasField("stop_id"):
+                continue
+            if stop_filter and stu.stop_id not in stop_filter:
+                continue
+            if stu.HasField("arrival"):
+                arrivals.append(
+                    {
+                        "trip_id": trip.trip_id,
+                        "stop_id": stu.stop_id,
+                        "arrival_epoch": stu.arrival.time,
+                        "arrival_time": feed_cache.epoch_to_time(stu.arrival.time),
+                    }
+                )
+
+    arrivals.sort(key=lambda x: (x["stop_id"], x["arrival_epoch"]))
+    return arrivals
+
+
+def bench(label, fn, number=2000):
+    seconds = min(timeit.repeat(fn, number=number, repeat=3)) / number
+    print(f"{label:<28} {seconds * 1e6:10.1f} us/call  {1 / seconds:12.0f} calls/s")
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else "response.bin"
+    route_id = sys.argv[2] if len(sys.argv) > 2 else "A"
+    stop_ids = sys.argv[3:] or ["A19N", "A18N"]
+
+    with open(path, "rb") as f:
+        entry = feed_cache.parse_feed(f.read())
+    feed = entry["feed"]
+
+    # Seed the cache directly so no MTA request is made.
+    url = "file://" + path
+    entry["ts"] = float("inf")
+    feed_cache._GTFS_CACHE[url] = entry
+    feed_cache.BACKGROUND_REFRESH = False
+
+    assert scan_arrivals(feed, route_id, stop_ids) == feed_cache.get_arrivals(
+        url, route_id, stop_ids
+    )
+
+    print(f"{path}: {len(feed.entity)} entities, route {route_id}, stops {stop_ids}")
+    bench("scan (per request)", lambda: scan_arrivals(feed, route_id, stop_ids))
+    bench("index lookup", lambda: feed_cache.get_arrivals(url, route_id, stop_ids))
+    bench("cached JSON", lambda: feed_cache.get_arrivals_json(url, route_id, stop_ids))
+    bench("index build (per refresh)", lambda: feed_cache.build_arrivals_index(feed), 200)
+
+    # ?enrich=1: a cache miss builds the body from the index + static joins.
+    arrivals_enrich.load()
+    for label, stops in (("stops", stop_ids), ("whole route", None)):
+        def build(enrich):
+            arrivals = feed_cache.entry_arrivals(entry, route_id, stops, enrich)
+            return json.dumps(arrivals, sort_keys=True, separators=(",", ":"))
+
+        print(f"\nuncached JSON body, {label} ({len(build(False))} / {len(build(True))} bytes)")
+        bench("raw", lambda: build(False))
+        bench("enrich=1", lambda: build(True))
+    bench(
+        "cached JSON, enrich=1",
+        lambda: feed_cache.get_arrivals_json(url, route_id, stop_ids, True),
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Compare the stored-blob codecs (blob_codecs.py) on captured feeds: ratio and
+compress / decompress throughput.
+
+zstd+dict uses a dictionary trained on the top-level fields (header and
+entities) of the *first* file only, so the numbers for the other files show
+how well it carries over to a snapshot it has not seen.
+
+Usage:
+    python3 bench_codecs.py [train.bin] [feed.bin ...]
+"""
+import sys
+import timeit
+
+import blob_codecs
+import snapshot_store
+
+
+def bench(label, blob, codec, dictionary=None):
+    compressed = blob_codecs.compress(blob, codec, dictionary)
+    assert blob_codecs.decompress(compressed, codec, dictionary) == blob
+
+    timer = timeit.Timer(lambda: blob_codecs.compress(blob, codec, dictionary))
+    number, _ = timer.autorange()
+    comp = min(timer.repeat(3, number)) / number
+
+    timer = timeit.Timer(lambda: blob_codecs.decompress(compressed, codec, dictionary))
+    number, _ = timer.autorange()
+    decomp = min(timer.repeat(3, number)) / number
+
+    mb = len(blob) / 1e6
+    print(
+        f"{label:<12} {len(compressed):>8} B {len(compressed) / len(blob):>7.1%}"
+        f" {mb / comp:>9.1f} MB/s {mb / decomp:>9.1f} MB/s"
+    )
+
+
+def main():
+    paths = sys.argv[1:] or ["response2.bin", "response.bin"]
+    blobs = {path: open(path, "rb").read() for path in paths}
+
+    dictionary = None
+    if "zstd" in blob_codecs.CODECS:
+        samples = [f.tobytes() for f in snapshot_store.split_fields(blobs[paths[0]])]
+        dictionary = blob_codecs.train_dictionary(samples, size=16 * 1024)
+        print(f"zstd dictionary: {len(dictionary)} bytes from {len(samples)} fields of {paths[0]}")
+
+    for path, blob in blobs.items():
+        print(f"\n{path}: {len(blob)} bytes")
+        print(f"{'codec':<12} {'size':>10} {'ratio':>7} {'compress':>14} {'decompress':>14}")
+        for codec in blob_codecs.CODECS:
+            bench(codec, blob, codec)
+        if dictionary is not None:
+            bench("zstd+dict", blob, "zstd", dictionary)
+
+
+if __name__ == "__main__":
+    main()
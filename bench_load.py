@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+"""
+Small wrk-style HTTP load generator (keep-alive GET, fixed connection count).
+
+Used to compare server.py (Flask) and server_async.py (ASGI) when wrk is not
+available. Latency is measured per request from send to the full response.
+
+Usage:
+    python3 bench_load.py URL [-c CONNECTIONS] [-d SECONDS] [--timeout SECONDS]
+"""
+import argparse
+import asyncio
+import statistics
+import time
+from urllib.parse import urlsplit
+
+
+async def _read_response(reader):
+    """Read one HTTP/1.1 response; returns (status, body length, keep-alive)."""
+    status_line = await reader.readline()
+    if not status_line:
+        raise ConnectionError("connection closed")
+    status = int(status_line.split()[1])
+
+    length = 0
+    chunked = False
+    keep_alive = True
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        name = name.strip().lower()
+        if name == "content-length":
+            length = int(value)
+        elif name == "transfer-encoding" and "chunked" in value.lower():
+            chunked = True
+        elif name == "connection" and "close" in value.lower():
+            keep_alive = False
+
+    if not chunked:
+        await reader.readexactly(length)
+        return status, length, keep_alive
+
+    total = 0
+    while True:
+        size = int((await reader.readline()).strip(), 16)
+        await reader.readexactly(size + 2)
+        if size == 0:
+            return status, total, keep_alive
+        total += size
+
+
+async def _worker(host, port, request, deadline, timeout, results):
+    reader = writer = None
+    while time.perf_counter() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, port)
+            start = time.perf_counter()
+            writer.write(request)
+            status, size, keep_alive = await asyncio.wait_for(
+                _read_response(reader), timeout
+            )
+            results["latencies"].append(time.perf_counter() - start)
+            results["bytes"] += size
+            if status >= 400:
+                results["non_2xx"] += 1
+            if not keep_alive:
+                # e.g. the Flask dev server: reconnect like wrk does.
+                writer.close()
+                writer = None
+        except asyncio.TimeoutError:
+            results["timeouts"] += 1
+            writer.close()
+            writer = None
+        except (OSError, ConnectionError, ValueError, asyncio.IncompleteReadError):
+            results["errors"] += 1
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+
+async def run(url, connections, duration, timeout):
+    parts = urlsplit(url)
+    path = parts.path + ("?" + parts.query if parts.query else "")
+    request = (
+        f"GET {path or '/'} HTTP/1.1\r\n"
+        f"Host: {parts.netloc}\r\n"
+        "Connection: keep-alive\r\n\r\n"
+    ).encode()
+
+    results = {"latencies": [], "bytes": 0, "errors": 0, "timeouts": 0, "non_2xx": 0}
+    start = time.perf_counter()
+    deadline = start + duration
+    await asyncio.gather(
+        *(
+            _worker(parts.hostname, parts.port or 80, request, deadline, timeout, results)
+            for _ in range(connections)
+        )
+    )
+    elapsed = time.perf_counter() - start
+
+    lat = sorted(results["latencies"])
+    count = len(lat)
+    print(f"Running {duration}s test @ {url}")
+    print(f"  {connections} connections")
+    if count:
+        print(
+            f"  Latency  avg {statistics.mean(lat) * 1000:8.2f}ms"
+            f"  p50 {lat[count // 2] * 1000:8.2f}ms"
+            f"  p99 {lat[min(count - 1, int(count * 0.99))] * 1000:8.2f}ms"
+            f"  max {lat[-1] * 1000:8.2f}ms"
+        )
+    print(f"  {count} requests in {elapsed:.2f}s, {results['bytes'] / 1e6:.2f}MB read")
+    print(
+        f"  Errors: connect/read {results['errors']}, timeout {results['timeouts']},"
+        f" non-2xx {results['non_2xx']}"
+    )
+    print(f"Requests/sec: {count / elapsed:10.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("url")
+    parser.add_argument("-c", "--connections", type=int, default=50)
+    parser.add_argument("-d", "--duration", type=float, default=30)
+    parser.add_argument("--timeout", type=float, default=2)
+    args = parser.parse_args()
+    asyncio.run(run(args.url, args.connections, args.duration, args.timeout))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of static GTFS lookups: the in-memory store (static_gtfs.py)
+vs. the SQL iqra-server.py runs per request on a warm (pooled) connection.
+
+The SQL side only runs when NEON_DATABASE_URL is set and the tables exist.
+
+Usage:
+    python3 bench_static.py [stop_id]
+"""
+import os
+import sys
+import time
+import timeit
+
+import psycopg2
+import psycopg2.extras
+
+import static_gtfs
+
+
+def bench(label, fn):
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    per_call = min(timer.repeat(3, number)) / number
+    print(f"{label:<32} {per_call * 1e6:>10.1f} us/call {1 / per_call:>12.0f} calls/s")
+
+
+def main():
+    stop_id = sys.argv[1] if len(sys.argv) > 1 else "B06S"
+
+    start = time.perf_counter()
+    tables = static_gtfs.load_from_files()
+    print(
+        f"loaded {sum(t.size for t in tables.values())} rows from "
+        f"{static_gtfs.GTFS_DIR} in {(time.perf_counter() - start) * 1000:.1f} ms"
+    )
+
+    bench("memory: stop by stop_id", lambda: tables["stops"].lookup("stop_id", stop_id))
+    bench("memory: transfers from stop", lambda: tables["transfers"].lookup("from_stop_id", stop_id[:3]))
+    bench("memory: trips by route_id", lambda: tables["trips"].lookup("route_id", "F"))
+
+    dsn = os.environ.get("NEON_DATABASE_URL")
+    if not dsn:
+        print("NEON_DATABASE_URL not set, skipping SQL")
+        return
+
+    conn = psycopg2.connect(dsn)
+    cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+
+    def sql(query, *params):
+        cur.execute(query, params)
+        return cur.fetchall()
+
+    bench("sql: stop by stop_id", lambda: sql("SELECT * FROM stops WHERE stop_id = %s", stop_id))
+    bench("sql: transfers from stop", lambda: sql(
+        "SELECT * FROM transfers WHERE from_stop_id = %s", stop_id[:3]
+    ))
+    bench("sql: trips by route_id", lambda: sql("SELECT * FROM trips WHERE route_id = %s", "F"))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+"""
+Compression codecs for blobs stored in the `raw` table.
+
+Each row records how its `data` was compressed (raw.codec, plus
+raw.codec_dict_id for zstd with a trained dictionary, see
+migrations/002_raw_codecs.sql), so readers pick the right decoder and old
+gzip rows can be recompressed in place (recompress_raw.py).
+
+    gzip   stdlib, what every row used before; always available
+    zstd   pip install zstandard; optionally with a dictionary trained on our
+           own stored snapshots (stop IDs, trip ID prefixes, NYCT extensions
+           repeat across every feed)
+    lz4    pip install lz4; fastest to decode, weakest ratio
+
+Codecs whose package is not installed are left out of CODECS.
+"""
+import functools
+import gzip
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+DEFAULT_CODEC = "gzip"
+ZSTD_LEVEL = 9  # ~60 MB/s on a feed, fast enough for the ingest; see bench_codecs.py
+DICT_SIZE = 64 * 1024  # bytes, target size of a trained zstd dictionary
+STREAM_CHUNK = 64 * 1024  # bytes per chunk out of decompress_stream()
+
+
+# ----------------------------
+#  Codecs
+# ----------------------------
+def _gzip_compress(data, dictionary=None):
+    # mtime=0 keeps the output deterministic for identical input.
+    return gzip.compress(data, mtime=0)
+
+
+def _gzip_decompress(data, dictionary=None):
+    return gzip.decompress(data)
+
+
+@functools.lru_cache(maxsize=8)
+def _zstd_dict(dictionary):
+    return zstandard.ZstdCompressionDict(dictionary)
+
+
+def _zstd_compress(data, dictionary=None):
+    if dictionary is None:
+        return zstandard.ZstdCompressor(level=ZSTD_LEVEL).compress(data)
+    zdict = _zstd_dict(dictionary)
+    return zstandard.ZstdCompressor(level=ZSTD_LEVEL, dict_data=zdict).compress(data)
+
+
+def _zstd_decompress(data, dictionary=None):
+    if dictionary is None:
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zstandard.ZstdDecompressor(dict_data=_zstd_dict(dictionary)).decompress(data)
+
+
+def _lz4_compress(data, dictionary=None):
+    return lz4.frame.compress(data)
+
+
+def _lz4_decompress(data, dictionary=None):
+    return lz4.frame.decompress(data)
+
+
+# name -> (compress(data, dictionary), decompress(data, dictionary))
+CODECS = {"gzip": (_gzip_compress, _gzip_decompress)}
+if zstandard is not None:
+    CODECS["zstd"] = (_zstd_compress, _zstd_decompress)
+if lz4 is not None:
+    CODECS["lz4"] = (_lz4_compress, _lz4_decompress)
+
+
+def _codec(name):
+    try:
+        return CODECS[name]
+    except KeyError:
+        raise ValueError(
+            f"Codec {name!r} is not available (installed: {', '.join(CODECS)})"
+        ) from None
+
+
+def compress(data, codec=DEFAULT_CODEC, dictionary=None):
+    """Compress `data` with `codec`. `dictionary` is the raw zstd dictionary bytes."""
+    if dictionary is not None and codec != "zstd":
+        raise ValueError(f"Codec {codec!r} does not take a dictionary")
+    return _codec(codec)[0](data, dictionary)
+
+
+def decompress(data, codec=DEFAULT_CODEC, dictionary=None):
+    """Inverse of compress()."""
+    return _codec(codec)[1](data, dictionary)
+
+
+# ----------------------------
+#  Streaming decompression
+# ----------------------------
+def _gzip_stream(data, dictionary, chunk_size):
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    view = memoryview(data)
+    for start in range(0, len(view), chunk_size):
+        pending = view[start:start + chunk_size]
+        while pending:
+            out = decompressor.decompress(pending, chunk_size)
+            if out:
+                yield out
+            pending = decompressor.unconsumed_tail
+    tail = decompressor.flush()
+    if tail:
+        yield tail
+
+
+def _zstd_stream(data, dictionary, chunk_size):
+    if dictionary is None:
+        decompressor = zstandard.ZstdDecompressor()
+    else:
+        decompressor = zstandard.ZstdDecompressor(dict_data=_zstd_dict(dictionary))
+    yield from decompressor.read_to_iter(data, read_size=chunk_size, write_size=chunk_size)
+
+
+def _lz4_stream(data, dictionary, chunk_size):
+    decompressor = lz4.frame.LZ4FrameDecompressor()
+    out = decompressor.decompress(data, max_length=chunk_size)
+    while True:
+        if out:
+            yield out
+        if decompressor.eof or decompressor.needs_input:
+            return
+        out = decompressor.decompress(b"", max_length=chunk_size)
+
+
+_STREAMS = {"gzip": _gzip_stream, "zstd": _zstd_stream, "lz4": _lz4_stream}
+
+
+def decompress_stream(data, codec=DEFAULT_CODEC, dictionary=None, chunk_size=STREAM_CHUNK):
+    """
+    decompress() as an iterator of chunks of at most `chunk_size` bytes, so
+    the whole output never has to sit in memory at once.
+    """
+    _codec(codec)
+    return _STREAMS[codec](data, dictionary, chunk_size)
+
+
+# ----------------------------
+#  zstd dictionaries (codec_dicts table)
+# ----------------------------
+_DICTS = {}  # codec_dicts.id -> dictionary bytes (rows are never updated)
+_DICTS_LOCK = threading.Lock()
+
+
+def train_dictionary(samples, size=DICT_SIZE):
+    """Train a zstd dictionary on `samples` (uncompressed snapshot bytes)."""
+    if zstandard is None:
+        raise ValueError("Training a dictionary needs zstandard installed")
+    return zstandard.train_dictionary(size, list(samples)).as_bytes()
+
+
+def store_dictionary(conn, dictionary):
+    """Insert `dictionary` into codec_dicts and return its id (not committed)."""
+    with conn.cursor() as cur:
+        cur.execute(
+            "INSERT INTO codec_dicts (codec, data) VALUES ('zstd', %s) RETURNING id;",
+            (dictionary,),
+        )
+        dict_id = cur.fetchone()[0]
+    with _DICTS_LOCK:
+        _DICTS[dict_id] = dictionary
+    return dict_id
+
+
+def load_dictionary(conn, dict_id):
+    """Dictionary bytes for codec_dicts.id, or None for `dict_id` None."""
+    if dict_id is None:
+        return None
+    with _DICTS_LOCK:
+        dictionary = _DICTS.get(dict_id)
+    if dictionary is not None:
+        return dictionary
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT data FROM codec_dicts WHERE id = %s;", (dict_id,))
+        row = cur.fetchone()
+    if row is None:
+        raise ValueError(f"Unknown codec dictionary {dict_id}")
+
+    dictionary = bytes(row[0])
+    with _DICTS_LOCK:
+        _DICTS[dict_id] = dictionary
+    return dictionary
+
+
+def decompress_row(conn, data, codec, dict_id):
+    """Decompress a stored `raw.data` value given its codec columns."""
+    return decompress(data, codec, load_dictionary(conn, dict_id))
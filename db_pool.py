@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+"""
+Shared, bounded Postgres connection pool for the Flask servers
+(serverAPI.py, iqra-server.py).
+
+Opening a connection to Neon costs a TLS handshake plus auth on every
+request; the pool keeps up to DB_POOL_MAX connections open and hands them
+out to request threads.
+
+  - DB_POOL_MIN / DB_POOL_MAX: connections opened together on the first
+    getconn() (none at import or construction) / upper bound.
+    Every connection that is given back stays open for reuse (unlike
+    psycopg2.pool, which closes everything above minconn on return).
+  - DB_POOL_TIMEOUT: seconds a request waits for a free connection before
+    failing with PoolTimeout (503 in the servers) instead of piling up
+  - Health checks: a connection that sat idle for more than
+    HEALTH_CHECK_AFTER seconds gets a `SELECT 1` before being handed out;
+    broken ones are dropped and replaced. Connections given back inside a
+    transaction are rolled back.
+  - stats(): checkouts, waits, timeouts, connects, discarded connections, ...
+
+Usage:
+    pool = db_pool.ConnectionPool(DATABASE_URL)
+    conn = pool.getconn()
+    try:
+        ...
+    finally:
+        pool.putconn(conn)
+"""
+import os
+import time
+import threading
+from collections import deque
+
+import psycopg2
+import psycopg2.extensions
+
+POOL_MIN = int(os.environ.get("DB_POOL_MIN", "1"))
+POOL_MAX = int(os.environ.get("DB_POOL_MAX", "10"))
+POOL_TIMEOUT = float(os.environ.get("DB_POOL_TIMEOUT", "5"))  # seconds
+HEALTH_CHECK_AFTER = 30  # seconds idle before a connection is re-checked
+
+
+class PoolTimeout(Exception):
+    """No connection became free within the acquire timeout."""
+
+
+class ConnectionPool:
+    """
+    Up to `maxconn` connections to `dsn`, shared between threads. Callers
+    that find every connection busy wait up to `timeout` seconds.
+
+    Nothing is opened until the first getconn(), so a server without a
+    configured database still starts.
+    """
+
+    def __init__(self, dsn, minconn=POOL_MIN, maxconn=POOL_MAX, timeout=POOL_TIMEOUT):
+        self.dsn = dsn
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._idle = deque()  # (conn, time.monotonic() when given back)
+        self._warmed = False
+
+        self._stats = {
+            "checkouts": 0,
+            "waits": 0,          # checkouts that had to wait for a free slot
+            "wait_ms_total": 0.0,
+            "timeouts": 0,
+            "connects": 0,       # new connections opened
+            "health_checks": 0,
+            "discarded": 0,      # broken connections dropped
+            "in_use": 0,
+        }
+
+    def _count(self, key, n=1):
+        with self._lock:
+            self._stats[key] += n
+
+    def _connect(self):
+        conn = psycopg2.connect(self.dsn)
+        self._count("connects")
+        return conn
+
+    def _warm(self):
+        """Open the first `minconn` connections (on first use)."""
+        with self._lock:
+            if self._warmed:
+                return
+            self._warmed = True
+        for _ in range(max(self.minconn - 1, 0)):
+            conn = self._connect()
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+
+    def _healthy(self, conn, idle_since):
+        if conn.closed:
+            return False
+        if time.monotonic() - idle_since < HEALTH_CHECK_AFTER:
+            return True
+
+        self._count("health_checks")
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1;")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _discard(self, conn):
+        self._count("discarded")
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def getconn(self):
+        """A healthy connection; waits up to `timeout` seconds for one."""
+        start = time.monotonic()
+        if not self._slots.acquire(blocking=False):
+            self._count("waits")
+            if not self._slots.acquire(timeout=self.timeout):
+                self._count("timeouts")
+                raise PoolTimeout(
+                    f"No database connection free after {self.timeout:g}s "
+                    f"({self.maxconn} in use)"
+                )
+
+        try:
+            if not self._warmed:
+                self._warm()
+            while True:
+                with self._lock:
+                    # Most recently used first: keeps the hot set small and
+                    # lets the rest go idle long enough to get re-checked.
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    conn = self._connect()
+                    break
+                conn, idle_since = item
+                if self._healthy(conn, idle_since):
+                    break
+                self._discard(conn)
+        except Exception:
+            self._slots.release()
+            raise
+
+        with self._lock:
+            self._stats["checkouts"] += 1
+            self._stats["in_use"] += 1
+            self._stats["wait_ms_total"] += (time.monotonic() - start) * 1000
+        return conn
+
+    def putconn(self, conn):
+        """Give a connection back (rolled back if left inside a transaction)."""
+        try:
+            if conn.closed:
+                self._count("discarded")
+                return
+
+            status = conn.info.transaction_status
+            if status == psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                self._discard(conn)  # server connection lost
+                return
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    self._discard(conn)
+                    return
+
+            with self._lock:
+                self._idle.append((conn, time.monotonic()))
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            result = dict(self._stats)
+            result["idle"] = len(self._idle)
+        result["min"] = self.minconn
+        result["max"] = self.maxconn
+        result["wait_ms_total"] = round(result["wait_ms_total"], 1)
+        return result
+
+    def closeall(self):
+        with self._lock:
+            idle, self._idle = self._idle, deque()
+        for conn, _ in idle:
+            conn.close()
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+In-memory cache of MTA GTFS-realtime feeds, shared by server.py and
+serverAPI.py.
+
+Every feed URL gets a background refresher thread that re-fetches the feed
+every MIN_REFRESH_INTERVAL seconds and swaps the newly parsed FeedMessage into
+the cache. Request threads only ever read from memory and always get the most
+recent feed, even while a refresh is in flight (stale-while-revalidate). Only
+the very first request for a URL waits for the initial fetch.
+
+Each time a new feed is parsed we also build an arrivals index
+(route_id -> stop_id -> arrivals sorted by epoch), so an arrivals request is
+a dict lookup plus concatenating a few pre-sorted slices instead of a walk
+over the whole feed. The encoded JSON for popular (route, stops) queries is
+kept in a small LRU keyed by the feed header timestamp, so repeat requests
+between refreshes skip encoding entirely.
+
+Set FEED_BACKGROUND_REFRESH=0 to fall back to fetching on demand once the
+cached copy is older than MIN_REFRESH_INTERVAL.
+
+Fetches are single-flight: concurrent misses for the same URL (including the
+refresher itself) share one download + parse, and every waiter gets its
+result or its exception.
+
+With FEED_SHARED_DIR set (multi-worker deployments), only one worker per host
+downloads each feed and publishes the raw bytes there; the other workers map
+that copy and re-parse only when its stamp changes (see shared_feed.py).
+
+With FEED_REPLAY set, "downloads" come from recorded snapshots instead of the
+MTA (see feed_replay.py); nothing else changes.
+"""
+import os
+import json
+import time
+import threading
+import requests
+
+import shared_feed
+import feed_replay
+import arrivals_enrich
+from feed_time import epoch_to_time
+
+from array import array
+from collections import OrderedDict
+from operator import itemgetter
+
+from google.transit import gtfs_realtime_pb2 as gtfs
+
+# ----------------------------
+#  Settings
+# ----------------------------
+MIN_REFRESH_INTERVAL = 10   # seconds between fetches of the same feed
+FETCH_TIMEOUT = 10          # seconds before a MTA request is abandoned
+BACKGROUND_REFRESH = os.environ.get("FEED_BACKGROUND_REFRESH", "1") != "0"
+RESPONSE_CACHE_SIZE = 512   # encoded arrivals responses kept in the LRU
+SHARED_DIR = os.environ.get("FEED_SHARED_DIR")
+SHARED_POLL_INTERVAL = 1    # seconds between checks of the shared copy
+
+# ----------------------------
+#  Cache state
+# ----------------------------
+# url -> {"ts": <fetch time>, "version": <feed header timestamp>,
+#         "feed": FeedMessage, "index": arrivals index,
+#         "terminals": trip_id -> last stop_id,
+#         "stamp", "blob": <shared copy stamp and mapped bytes, FEED_SHARED_DIR only>}
+_GTFS_CACHE = {}
+_GTFS_CACHE_LOCK = threading.Lock()
+# Notified whenever a feed with a new version is stored.
+_FEED_UPDATED = threading.Condition(_GTFS_CACHE_LOCK)
+
+# url -> Thread
+_REFRESHERS = {}
+
+# url -> {"done": Event, "entry": cache entry | None, "error": Exception | None}
+_IN_FLIGHT = {}
+
+# (route_id, sorted stop_ids, version) -> encoded JSON bytes
+_RESPONSE_CACHE = OrderedDict()
+
+_STATS = {
+    "fetches": 0,         # downloads + parses actually performed
+    "coalesced": 0,       # callers that waited on someone else's fetch
+    "fetch_errors": 0,
+    "downloads": 0,       # requests to the MTA made by this process
+    "parses": 0,
+    "shared_fallbacks": 0,  # FEED_SHARED_DIR copy unreadable, downloaded here
+    "response_hits": 0,   # arrivals served from the encoded-JSON LRU
+    "response_misses": 0,
+}
+
+
+# ----------------------------
+#  Feed URL Builder
+# ----------------------------
+BASE_URL = os.environ.get(
+    "FEED_BASE_URL",
+    "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs",
+)
+
+def build_feed_url(route_id):
+    match route_id:
+        case "A" | "C" | "E":
+            return BASE_URL + "-ace"
+        case "B" | "D" | "F" | "M":
+            return BASE_URL + "-bdfm"
+        case "G":
+            return BASE_URL + "-g"
+        case "J" | "Z":
+            return BASE_URL + "-jz"
+        case "N" | "Q" | "R" | "W":
+            return BASE_URL + "-nqrw"
+        case "L":
+            return BASE_URL + "-l"
+        case "1" | "2" | "3" | "4" | "5" | "6" | "7" | "S":
+            return BASE_URL
+        case _:
+            return None
+
+
+def feed_name(url):
+    """Route-group key of a feed URL, e.g. "bdfm" (same keys as gtfs_ingest)."""
+    return url.rsplit("gtfs", 1)[-1].lstrip("-") or "number"
+
+
+def route_group(route_id):
+    """Route-group key serving `route_id`, or None for an unknown route."""
+    url = build_feed_url(route_id)
+    return feed_name(url) if url else None
+
+
+# Recorded feeds to serve instead of the MTA (FEED_REPLAY, see feed_replay.py),
+# set up on first use: importing this module has to stay cheap, since
+# history.py's decode workers re-import the server's main module.
+_REPLAY = None
+_REPLAY_LOCK = threading.Lock()
+
+
+def replay():
+    """The FeedReplay configured by FEED_REPLAY*, or None when replay is off."""
+    global _REPLAY
+    if not os.environ.get("FEED_REPLAY"):
+        return None
+    with _REPLAY_LOCK:
+        if _REPLAY is None:
+            _REPLAY = feed_replay.from_env(route_group)
+        return _REPLAY
+
+
+# ----------------------------
+#  Arrivals index
+# ----------------------------
+def build_arrivals_index(feed):
+    """
+    route_id -> stop_id -> (epochs, trip_ids, times), each stop sorted by
+    arrival epoch. `epochs` is an array("q"); the others are tuples.
+
+    Ties keep feed order, so results match sorting the flat list by
+    (stop_id, arrival_epoch) like the handlers used to do.
+    """
+    by_route = {}
+    for ent in feed.entity:
+        if not ent.HasField("trip_update"):
+            continue
+
+        trip = ent.trip_update.trip
+        stops = by_route.setdefault(trip.route_id, {})
+        trip_id = trip.trip_id
+
+        for stu in ent.trip_update.stop_time_update:
+            if not stu.HasField("stop_id") or not stu.HasField("arrival"):
+                continue
+            stops.setdefault(stu.stop_id, []).append((stu.arrival.time, trip_id))
+
+    index = {}
+    for route_id, stops in by_route.items():
+        route_index = {}
+        for stop_id, rows in stops.items():
+            rows.sort(key=itemgetter(0))
+            epochs = array("q", (epoch for epoch, _ in rows))
+            route_index[stop_id] = (
+                epochs,
+                tuple(trip_id for _, trip_id in rows),
+                tuple(epoch_to_time(epoch) for epoch in epochs),
+            )
+        index[route_id] = route_index
+    return index
+
+
+def build_trip_terminals(feed):
+    """trip_id -> stop_id of the last stop in its trip update (for ?enrich=1)."""
+    terminals = {}
+    for ent in feed.entity:
+        if ent.HasField("trip_update") and ent.trip_update.stop_time_update:
+            terminals[ent.trip_update.trip.trip_id] = (
+                ent.trip_update.stop_time_update[-1].stop_id
+            )
+    return terminals
+
+
+def entry_arrivals(entry, route_id, stop_ids=None, enrich=False):
+    """get_arrivals() for an already-fetched cache entry."""
+    route_index = entry["index"].get(route_id, {})
+
+    if stop_ids:
+        wanted = sorted(set(stop_ids))
+    else:
+        wanted = sorted(route_index)
+
+    arrivals = []
+    for stop_id in wanted:
+        stop = route_index.get(stop_id)
+        if stop is None:
+            continue
+        for epoch, trip_id, arrival_time in zip(*stop):
+            arrivals.append(
+                {
+                    "trip_id": trip_id,
+                    "stop_id": stop_id,
+                    "arrival_epoch": epoch,
+                    "arrival_time": arrival_time,
+                }
+            )
+    if enrich:
+        arrivals_enrich.enrich(arrivals, route_id, entry["terminals"])
+    return arrivals
+
+
+def get_arrivals(url, route_id, stop_ids=None, enrich=False):
+    """
+    Arrivals for `route_id`, optionally limited to `stop_ids`, sorted by
+    (stop_id, arrival_epoch). With `enrich`, each one also carries static
+    GTFS details (stop_name, trip_headsign, ...; see arrivals_enrich.py).
+    """
+    return entry_arrivals(get_entry(url), route_id, stop_ids, enrich)
+
+
+def arrivals_json(entry, route_id, stop_ids=None, enrich=False):
+    """
+    Arrivals from a cache entry, encoded as JSON bytes and kept in the LRU.
+
+    Returns (body, version) where `version` is the feed header timestamp the
+    body was built from; callers use it for ETag / Last-Modified.
+    """
+    version = entry["version"]
+    key = (route_id, tuple(sorted(set(stop_ids or ()))), bool(enrich), version)
+
+    with _GTFS_CACHE_LOCK:
+        body = _RESPONSE_CACHE.get(key)
+        if body is not None:
+            _RESPONSE_CACHE.move_to_end(key)
+            _STATS["response_hits"] += 1
+            return body, version
+        _STATS["response_misses"] += 1
+
+    arrivals = entry_arrivals(entry, route_id, key[1], enrich)
+    body = json.dumps(arrivals, sort_keys=True, separators=(",", ":")).encode()
+
+    with _GTFS_CACHE_LOCK:
+        _RESPONSE_CACHE[key] = body
+        while len(_RESPONSE_CACHE) > RESPONSE_CACHE_SIZE:
+            _RESPONSE_CACHE.popitem(last=False)
+    return body, version
+
+
+def get_arrivals_json(url, route_id, stop_ids=None, enrich=False):
+    """Same as get_arrivals(), already encoded as JSON bytes (see above)."""
+    return arrivals_json(get_entry(url), route_id, stop_ids, enrich)
+
+
+# ----------------------------
+#  Fetching
+# ----------------------------
+def download_feed(url):
+    """Raw GTFS-realtime protobuf bytes for `url` (the replayed ones with FEED_REPLAY)."""
+    replayed = replay()
+    if replayed is not None:
+        return replayed.download(feed_name(url))
+    resp = requests.get(url, timeout=FETCH_TIMEOUT)
+    resp.raise_for_status()
+    return resp.content
+
+
+def parse_feed(blob):
+    """Parse feed bytes into a cache entry, building the arrivals index."""
+    feed = gtfs.FeedMessage()
+    feed.ParseFromString(blob)
+
+    now = time.time()
+    return {
+        "ts": now,
+        "version": feed.header.timestamp or int(now),
+        "feed": feed,
+        "index": build_arrivals_index(feed),
+        "terminals": build_trip_terminals(feed),
+    }
+
+
+def _load_shared(url, current):
+    """
+    Entry for `url` from the host-wide shared copy, downloading it first if
+    this process is the elected fetcher and the copy is due for a refresh.
+    Returns `current` (still on its mapping, `ts` moved to the latest fetch)
+    when the shared stamp has not moved, and falls back to a download of its
+    own when the copy cannot be mapped.
+    """
+    name = feed_name(url)
+    header = shared_feed.read_header(SHARED_DIR, name)
+    stale = header is None or time.time() - header[1] >= MIN_REFRESH_INTERVAL
+
+    if stale and shared_feed.try_lead(SHARED_DIR, name):
+        blob = download_feed(url)
+        with _GTFS_CACHE_LOCK:
+            _STATS["downloads"] += 1
+        shared_feed.publish(SHARED_DIR, name, blob)
+        header = shared_feed.read_header(SHARED_DIR, name)
+    elif header is None:
+        # Another worker is fetching: wait for its first copy.
+        deadline = time.monotonic() + FETCH_TIMEOUT
+        while header is None:
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"No shared copy of {name} in {SHARED_DIR}")
+            time.sleep(0.1)
+            header = shared_feed.read_header(SHARED_DIR, name)
+
+    if current is not None and header is not None and current.get("stamp") == header[0]:
+        # Same bytes, fetched again: age the entry from the latest fetch.
+        current["ts"] = header[1]
+        return current
+
+    attached = shared_feed.attach(SHARED_DIR, name)
+    if attached is None:
+        # Removed or overwritten with something else since the header read.
+        with _GTFS_CACHE_LOCK:
+            _STATS["shared_fallbacks"] += 1
+        return _load_local(url)
+
+    stamp, fetched_at, mm, view = attached
+    if current is not None and current.get("stamp") == stamp:
+        view.release()
+        mm.close()
+        current["ts"] = fetched_at
+        return current
+
+    # Parse straight from the mapping; `view` keeps it alive with the entry.
+    entry = parse_feed(view)
+    entry.update(ts=fetched_at, stamp=stamp, blob=view)
+    with _GTFS_CACHE_LOCK:
+        _STATS["parses"] += 1
+    return entry
+
+
+def _load_local(url):
+    entry = parse_feed(download_feed(url))
+    with _GTFS_CACHE_LOCK:
+        _STATS["downloads"] += 1
+        _STATS["parses"] += 1
+    return entry
+
+
+def _load(url, current):
+    if SHARED_DIR:
+        return _load_shared(url, current)
+    return _load_local(url)
+
+
+def _fetch(url):
+    """
+    Fetch `url` and store it in the cache, sharing the work with any other
+    caller that is already fetching the same URL.
+    """
+    with _GTFS_CACHE_LOCK:
+        current = _GTFS_CACHE.get(url)
+        call = _IN_FLIGHT.get(url)
+        leader = call is None
+        if leader:
+            call = {"done": threading.Event(), "entry": None, "error": None}
+            _IN_FLIGHT[url] = call
+            _STATS["fetches"] += 1
+        else:
+            _STATS["coalesced"] += 1
+
+    if not leader:
+        call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        return call["entry"]
+
+    try:
+        entry = _load(url, current)
+    except Exception as e:
+        call["error"] = e
+        with _GTFS_CACHE_LOCK:
+            _STATS["fetch_errors"] += 1
+        raise
+    else:
+        call["entry"] = entry
+        with _GTFS_CACHE_LOCK:
+            previous = _GTFS_CACHE.get(url)
+            _GTFS_CACHE[url] = entry
+            if previous is None or previous["version"] != entry["version"]:
+                _FEED_UPDATED.notify_all()
+        return entry
+    finally:
+        with _GTFS_CACHE_LOCK:
+            del _IN_FLIGHT[url]
+        call["done"].set()
+
+
+def _refresh_loop(url):
+    # With a shared copy, poll it often; only the fetcher hits the MTA, and
+    # only every MIN_REFRESH_INTERVAL.
+    interval = SHARED_POLL_INTERVAL if SHARED_DIR else MIN_REFRESH_INTERVAL
+    next_run = time.monotonic()
+    while True:
+        try:
+            _fetch(url)
+        except Exception as e:
+            # Keep serving the previous feed until the next attempt.
+            print(f"[feed_cache] refresh failed for {url}: {e}")
+
+        # Fixed-rate schedule: a slow fetch does not push the next one back.
+        next_run += interval
+        delay = next_run - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            next_run = time.monotonic()
+
+
+def start_refresher(url):
+    """Start the background refresher for `url` if it is not running yet."""
+    with _GTFS_CACHE_LOCK:
+        if url in _REFRESHERS:
+            return
+        thread = threading.Thread(
+            target=_refresh_loop,
+            args=(url,),
+            name=f"feed-refresher-{feed_name(url)}",
+            daemon=True,
+        )
+        _REFRESHERS[url] = thread
+
+    thread.start()
+
+
+def get_entry(url):
+    """Latest cache entry for `url` (see get_feed for when this blocks)."""
+    with _GTFS_CACHE_LOCK:
+        entry = _GTFS_CACHE.get(url)
+
+    if BACKGROUND_REFRESH:
+        start_refresher(url)
+        if entry is not None:
+            return entry
+    elif entry is not None and time.time() - entry["ts"] < MIN_REFRESH_INTERVAL:
+        return entry
+
+    return _fetch(url)
+
+
+def wait_for_update(url, version, timeout):
+    """
+    Block until `url` has a feed newer than `version` or `timeout` seconds
+    pass, then return the latest cache entry.
+    """
+    with _FEED_UPDATED:
+        _FEED_UPDATED.wait_for(
+            lambda: url in _GTFS_CACHE and _GTFS_CACHE[url]["version"] != version,
+            timeout,
+        )
+    return get_entry(url)
+
+
+def get_feed(url):
+    """
+    Return the latest parsed FeedMessage for `url`.
+
+    With background refresh on, this only reads memory once the first fetch
+    has landed; that first call joins the refresher's in-flight fetch and
+    re-raises its error if it failed.
+    """
+    return get_entry(url)["feed"]
+
+
+def stats():
+    """Snapshot of the fetch counters, plus the feeds currently cached."""
+    with _GTFS_CACHE_LOCK:
+        result = dict(_STATS)
+        result["in_flight"] = len(_IN_FLIGHT)
+        result["cached_responses"] = len(_RESPONSE_CACHE)
+        result["feeds"] = {
+            feed_name(url): round(time.time() - entry["ts"], 1)
+            for url, entry in _GTFS_CACHE.items()
+        }
+    if replay() is not None:
+        result["replay"] = replay().stats()
+    return result
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Replay recorded feeds instead of fetching them from the MTA, for load tests
+and benchmarks that should not depend on (or hammer) the live API.
+
+With FEED_REPLAY set, feed_cache.download_feed() (and server_async.py's
+fetch) return the recorded snapshot that was current at the replay clock.
+Everything downstream is unchanged: the refresh interval, single-flight
+fetches, versions from the feed header, the response LRU, SSE diffs.
+
+    FEED_REPLAY=dir:<path>      .bin captures, either in <path>/<group>/
+                                (group as in gtfs_ingest.ROUTE_GROUPS) or
+                                directly in <path>, grouped by the route of
+                                their first trip update; timed by their feed
+                                header timestamp
+    FEED_REPLAY=archive:<path>  a snapshot_archive.py archive
+    FEED_REPLAY=db              the raw table (DATABASE_URL, or
+                                NEON_DATABASE_URL), timed by created_at
+
+    FEED_REPLAY_SPEED  1 = real time (default), 10 = ten times faster,
+                       0 = step: each download returns the group's next
+                       snapshot, whatever the wall clock says
+    FEED_REPLAY_START  ISO timestamp (UTC) to start at (default: the
+                       earliest recording)
+    FEED_REPLAY_LOOP   1 (default): start over after the last recording;
+                       0: keep serving the last one
+
+The clock starts at the first download and is shared by all groups, so
+feeds stay in step with each other.
+"""
+import os
+import time
+import bisect
+import datetime
+import threading
+
+from google.transit import gtfs_realtime_pb2 as gtfs
+
+import snapshot_store
+import snapshot_archive
+
+
+# ----------------------------
+#  Sources
+# ----------------------------
+class _DirSource:
+    """Recorded .bin files."""
+
+    name = "dir"
+
+    def __init__(self, path, group_of_route):
+        captures = {}  # group -> [(header timestamp, path)]
+        for entry in sorted(os.listdir(path)):
+            full = os.path.join(path, entry)
+            if os.path.isdir(full):
+                for name in sorted(os.listdir(full)):
+                    if name.endswith(".bin"):
+                        file_path = os.path.join(full, name)
+                        feed = self._parse(file_path)
+                        captures.setdefault(entry, []).append((feed.header.timestamp, file_path))
+            elif entry.endswith(".bin"):
+                feed = self._parse(full)
+                route_ids = [
+                    ent.trip_update.trip.route_id
+                    for ent in feed.entity
+                    if ent.HasField("trip_update")
+                ]
+                group = next((g for g in map(group_of_route, route_ids) if g), None)
+                if group is None:
+                    print(f"[feed_replay] skipping {full}: no known route in it")
+                    continue
+                captures.setdefault(group, []).append((feed.header.timestamp, full))
+
+        self.times = {}
+        self.paths = {}
+        for group, items in captures.items():
+            items.sort()
+            self.times[group] = [float(ts) for ts, _ in items]
+            self.paths[group] = [p for _, p in items]
+
+    @staticmethod
+    def _parse(path):
+        feed = gtfs.FeedMessage()
+        with open(path, "rb") as f:
+            feed.ParseFromString(f.read())
+        return feed
+
+    def load(self, group, pos):
+        with open(self.paths[group][pos], "rb") as f:
+            return f.read()
+
+
+class _ArchiveSource:
+    """A snapshot_archive.py archive."""
+
+    name = "archive"
+
+    def __init__(self, path):
+        if not os.path.isdir(os.path.join(path, "index")):
+            raise ValueError(f"No snapshot archive at {path}")
+        self.archive = snapshot_archive.SnapshotArchive(path)
+        self.times = {g: self.archive.timestamps(g) for g in self.archive.groups()}
+
+    def load(self, group, pos):
+        return self.archive.get(group, pos)
+
+
+class _DbSource:
+    """Rows of the raw table."""
+
+    name = "db"
+
+    def __init__(self, dsn):
+        import psycopg2
+
+        if not dsn:
+            raise ValueError("FEED_REPLAY=db needs DATABASE_URL or NEON_DATABASE_URL")
+        self.conn = psycopg2.connect(dsn)
+        self.lock = threading.Lock()
+        with self.conn.cursor() as cur:
+            cur.execute(
+                "SELECT route_group, id, extract(epoch FROM created_at) "
+                "FROM raw ORDER BY created_at, id;"
+            )
+            rows = cur.fetchall()
+        self.conn.rollback()
+
+        self.times = {}
+        self.ids = {}
+        for group, row_id, ts in rows:
+            self.times.setdefault(group, []).append(float(ts))
+            self.ids.setdefault(group, []).append(row_id)
+
+    def load(self, group, pos):
+        with self.lock:
+            try:
+                return snapshot_store.load_snapshot(self.conn, self.ids[group][pos])
+            finally:
+                self.conn.rollback()
+
+
+# ----------------------------
+#  Replay clock
+# ----------------------------
+class FeedReplay:
+    """Picks, per route group, the recording to serve at each download."""
+
+    def __init__(self, source, speed=1.0, start=None, loop=True):
+        self.source = source
+        self.speed = speed
+        self.loop = loop
+
+        times = [t for t in source.times.values() if t]
+        if not times:
+            raise ValueError("FEED_REPLAY source has no recorded snapshots")
+        self.start = start if start is not None else min(t[0] for t in times)
+        self.end = max(t[-1] for t in times)
+
+        self._lock = threading.Lock()
+        self._wall_start = None
+        self._steps = {}  # group -> next position, speed 0 only
+
+    def clock(self):
+        """Replay time now, in epoch seconds."""
+        with self._lock:
+            if self._wall_start is None:
+                self._wall_start = time.monotonic()
+            elapsed = (time.monotonic() - self._wall_start) * self.speed
+
+        span = self.end - self.start
+        if self.loop and span > 0:
+            elapsed %= span
+        return min(self.start + elapsed, self.end)
+
+    def _position(self, group, times):
+        if self.speed == 0:
+            with self._lock:
+                first = min(bisect.bisect_left(times, self.start), len(times) - 1)
+                pos = self._steps.get(group, first)
+                if pos >= len(times):
+                    pos = first if self.loop else len(times) - 1
+                self._steps[group] = pos + 1
+            return pos
+        # Latest recording at or before the clock (the first one before it starts).
+        return max(bisect.bisect_right(times, self.clock()) - 1, 0)
+
+    def download(self, group):
+        """Feed bytes of `group` to serve now."""
+        times = self.source.times.get(group)
+        if not times:
+            raise LookupError(f"No recorded snapshots for {group!r} in FEED_REPLAY")
+        return self.source.load(group, self._position(group, times))
+
+    def stats(self):
+        clock = None
+        if self.speed != 0:
+            clock = datetime.datetime.fromtimestamp(
+                self.clock(), datetime.timezone.utc
+            ).isoformat()
+        return {
+            "source": self.source.name,
+            "speed": self.speed,
+            "clock": clock,
+            "snapshots": {g: len(t) for g, t in self.source.times.items()},
+        }
+
+
+def from_env(group_of_route):
+    """
+    FeedReplay configured by FEED_REPLAY*, or None when replay is off.
+    `group_of_route` maps a route_id to its group key, or None if unknown.
+    """
+    spec = os.environ.get("FEED_REPLAY")
+    if not spec:
+        return None
+
+    kind, _, path = spec.partition(":")
+    if kind == "dir":
+        source = _DirSource(path, group_of_route)
+    elif kind == "archive":
+        source = _ArchiveSource(path)
+    elif kind == "db":
+        source = _DbSource(os.environ.get("DATABASE_URL") or os.environ.get("NEON_DATABASE_URL"))
+    else:
+        raise ValueError(f"FEED_REPLAY must be dir:<path>, archive:<path> or db, not {spec!r}")
+
+    start = os.environ.get("FEED_REPLAY_START")
+    if start:
+        start = datetime.datetime.fromisoformat(start)
+        if start.tzinfo is None:
+            start = start.replace(tzinfo=datetime.timezone.utc)
+        start = start.timestamp()
+
+    replay = FeedReplay(
+        source,
+        speed=float(os.environ.get("FEED_REPLAY_SPEED", "1")),
+        start=start,
+        loop=os.environ.get("FEED_REPLAY_LOOP", "1") != "0",
+    )
+    print(
+        f"[feed_replay] replaying {sum(len(t) for t in source.times.values())} snapshots "
+        f"of {', '.join(sorted(source.times))} from {spec} at speed {replay.speed:g}"
+    )
+    return replay
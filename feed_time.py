@@ -0,0 +1,10 @@
+#!/usr/bin/env python3
+"""
+Time formatting shared by the live arrivals (feed_cache.py) and the decode
+workers of history.py, which have no use for the rest of feed_cache.
+"""
+import datetime
+
+
+def epoch_to_time(ts):
+    return datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S")
@@ -2,11 +2,23 @@
 from dotenv import load_dotenv
 load_dotenv(".env")
 
+import io
 import os
+import time
 import psycopg2
+import psycopg2.extras
 import requests
 import hashlib
-import gzip
+from datetime import datetime, timezone
+
+from google.transit import gtfs_realtime_pb2
+
+import blob_codecs
+import snapshot_store
+import snapshot_archive
+
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 
 DATABASE_URL = os.environ.get("NEON_DATABASE_URL")
 
@@ -22,6 +34,46 @@ ROUTE_GROUPS = {
 
 BASE_URL = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs"
 
+FETCH_TIMEOUT = 10  # seconds, per group
+
+# group_key -> {"digest", "etag", "last_modified"} of the last snapshot that
+# was stored. Lets a long-running ingest (scheduled_polling.py) skip feeds the
+# MTA republished unchanged before compressing or talking to Postgres.
+_LAST_SEEN = {}
+
+# "full": every row is a whole snapshot. "delta": keyframes plus deltas
+# against the previous row (see snapshot_store.py; needs migrations/001).
+STORAGE_MODE = os.environ.get("RAW_STORAGE", "full")
+
+# group_key -> {"id", "blob", "deltas"}: the last row this process inserted,
+# used as the base of the next delta.
+_LAST_STORED = {}
+
+# Codec for new rows (blob_codecs.py; anything but plain gzip needs
+# migrations/002), and optionally a codec_dicts.id to compress zstd with.
+CODEC = os.environ.get("RAW_CODEC", blob_codecs.DEFAULT_CODEC)
+CODEC_DICT_ID = os.environ.get("RAW_CODEC_DICT")
+CODEC_DICT_ID = int(CODEC_DICT_ID) if CODEC_DICT_ID else None
+
+# TRIP_UPDATES=1: also decode every new snapshot into the trip_updates table
+# (needs migrations/003_trip_updates.sql). Off by default: the COPY shares the
+# raw insert's transaction, so without the table no snapshot would be stored.
+DECODE_TRIP_UPDATES = os.environ.get("TRIP_UPDATES", "0") == "1"
+
+# Where new snapshots go: "db" (the raw table), "archive" (local segment
+# files under SNAPSHOT_ARCHIVE_DIR, see snapshot_archive.py) or "both".
+RAW_SINK = os.environ.get("RAW_SINK", "db")
+if RAW_SINK not in ("db", "archive", "both"):
+    raise ValueError(f"RAW_SINK must be db, archive or both, not {RAW_SINK!r}")
+WRITE_DB = RAW_SINK != "archive"
+WRITE_ARCHIVE = RAW_SINK != "db"
+ARCHIVE_DIR = os.environ.get("SNAPSHOT_ARCHIVE_DIR", "archive")
+
+_ARCHIVE = None
+# group_key -> digest of the last snapshot appended to the archive, so a
+# cycle retried after a failed DB insert does not archive it twice.
+_LAST_ARCHIVED = {}
+
 
 def get_connection():
     if not DATABASE_URL:
@@ -32,57 +84,310 @@ def get_connection():
     return psycopg2.connect(DATABASE_URL)
 
 
-def fetch_feed(group_key: str) -> bytes:
-    """Fetch raw GTFS-realtime protobuf bytes for the given route group."""
+def get_session():
+    """
+    HTTP session with keep-alive connections to the MTA, sized so every
+    route group can be fetched at the same time.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=len(ROUTE_GROUPS))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def fetch_snapshot(group_key: str, session=requests):
+    """
+    Fetch the feed for `group_key`, sending If-None-Match / If-Modified-Since
+    from the last stored snapshot.
+
+    Returns None if the feed is unchanged (304, or byte-identical), otherwise
+    {"blob", "digest", "etag", "last_modified"}.
+    """
     if group_key == "number":
         url = BASE_URL  # no suffix for 1/2/3/4/5/6/7/S
     else:
         url = f"{BASE_URL}-{group_key}"
 
-    print(f"[{url}] requested")
-    resp = requests.get(url, timeout=10)
+    seen = _LAST_SEEN.get(group_key, {})
+    headers = {}
+    if seen.get("etag"):
+        headers["If-None-Match"] = seen["etag"]
+    if seen.get("last_modified"):
+        headers["If-Modified-Since"] = seen["last_modified"]
+
+    resp = session.get(url, headers=headers, timeout=FETCH_TIMEOUT)
+    if resp.status_code == 304:
+        return None
     resp.raise_for_status()
-    return resp.content  # raw protobuf bytes
+
+    blob = resp.content  # raw protobuf bytes
+    digest = hashlib.md5(blob).hexdigest()
+    if digest == seen.get("digest"):
+        return None
+
+    return {
+        "blob": blob,
+        "digest": digest,
+        "etag": resp.headers.get("ETag"),
+        "last_modified": resp.headers.get("Last-Modified"),
+    }
+
+
+def _timed_fetch(session, group_key):
+    start = time.perf_counter()
+    try:
+        snapshot = fetch_snapshot(group_key, session)
+    except Exception as e:
+        elapsed = time.perf_counter() - start
+        print(f"[{group_key}] fetch failed after {elapsed * 1000:.0f} ms: {e}")
+        return group_key, None
+
+    elapsed = time.perf_counter() - start
+    if snapshot is None:
+        print(f"[{group_key}] unchanged, checked in {elapsed * 1000:.0f} ms")
+    else:
+        print(
+            f"[{group_key}] fetched {len(snapshot['blob'])} bytes "
+            f"in {elapsed * 1000:.0f} ms"
+        )
+    return group_key, snapshot
 
 
-def insert_raw_blob(conn, blob: bytes, route_group: str):
+def fetch_all(session) -> dict:
     """
-    Compress the protobuf bytes, hash the compressed data,
-    and store the compressed blob in the 'raw' table.
+    Fetch every route group concurrently over `session`.
+
+    Returns {group_key: snapshot} for groups that changed since the last
+    stored snapshot; unchanged groups and groups that failed (logged) are
+    left out so one bad feed does not cost the others their snapshot.
     """
-    # 1) Compress (gzip)
-    compressed = gzip.compress(blob)
+    with ThreadPoolExecutor(max_workers=len(ROUTE_GROUPS)) as pool:
+        results = pool.map(lambda g: _timed_fetch(session, g), ROUTE_GROUPS)
+        return {
+            group_key: snapshot
+            for group_key, snapshot in results
+            if snapshot is not None
+        }
+
+
+def _encode_row(group_key, snapshot):
+    """(payload, storage, base_id) for one snapshot, per STORAGE_MODE."""
+    blob = snapshot["blob"]
+    last = _LAST_STORED.get(group_key)
+    if (
+        STORAGE_MODE != "delta"
+        or last is None
+        or last["deltas"] + 1 >= snapshot_store.KEYFRAME_INTERVAL
+    ):
+        return blob, "full", None
+    return snapshot_store.encode_delta(last["blob"], blob), "delta", last["id"]
+
+
+def _copy_value(value):
+    """One field in COPY text format."""
+    if value is None:
+        return "\\N"
+    return (
+        value.replace("\\", "\\\\")
+        .replace("\t", "\\t")
+        .replace("\n", "\\n")
+        .replace("\r", "\\r")
+    )
+
+
+def _copy_ts(epoch):
+    if not epoch:
+        return None
+    return datetime.fromtimestamp(epoch, timezone.utc).isoformat()
 
-    # 2) Hash the compressed data
-    data_hash = hashlib.md5(compressed).hexdigest()
 
-    # 3) Insert compressed blob into BYTEA column `data`
-    sql = """
-        INSERT INTO raw (data, data_hash, route_group)
-        VALUES (%s, %s, %s)
-        ON CONFLICT (data_hash) DO NOTHING;
+def decode_trip_updates(blob):
     """
+    (route_id, trip_id, stop_id, arrival, departure, feed_ts) for every stop
+    time update in a FeedMessage, times as ISO strings (None if absent).
+    feed_ts falls back to now if the header has no timestamp.
+    """
+    feed = gtfs_realtime_pb2.FeedMessage()
+    feed.ParseFromString(blob)
+    feed_ts = _copy_ts(feed.header.timestamp or time.time())
 
-    with conn.cursor() as cur:
+    rows = []
+    for ent in feed.entity:
+        if not ent.HasField("trip_update"):
+            continue
+        trip = ent.trip_update.trip
+        for stu in ent.trip_update.stop_time_update:
+            if not stu.stop_id:
+                continue
+            rows.append((
+                trip.route_id,
+                trip.trip_id,
+                stu.stop_id,
+                _copy_ts(stu.arrival.time) if stu.HasField("arrival") else None,
+                _copy_ts(stu.departure.time) if stu.HasField("departure") else None,
+                feed_ts,
+            ))
+    return rows
+
+
+def copy_trip_updates(cur, snapshot_blobs) -> int:
+    """
+    Bulk-load the decoded stop time updates of {snapshot_id: blob} into
+    trip_updates with one COPY. Returns the number of rows written.
+    """
+    buf = io.StringIO()
+    count = 0
+    for snapshot_id, blob in snapshot_blobs.items():
+        for row in decode_trip_updates(blob):
+            buf.write(str(snapshot_id))
+            for value in row:
+                buf.write("\t")
+                buf.write(_copy_value(value))
+            buf.write("\n")
+            count += 1
+
+    buf.seek(0)
+    cur.copy_expert(
+        "COPY trip_updates "
+        "(snapshot_id, route_id, trip_id, stop_id, arrival, departure, feed_ts) "
+        "FROM STDIN",
+        buf,
+    )
+    return count
+
+
+def _remember_seen(snapshots):
+    for group_key, snapshot in snapshots.items():
+        _LAST_SEEN[group_key] = {
+            "digest": snapshot["digest"],
+            "etag": snapshot["etag"],
+            "last_modified": snapshot["last_modified"],
+        }
+
+
+def get_archive():
+    global _ARCHIVE
+    if _ARCHIVE is None:
+        _ARCHIVE = snapshot_archive.SnapshotArchive(ARCHIVE_DIR)
+    return _ARCHIVE
+
+
+def archive_snapshots(snapshots: dict) -> int:
+    """
+    Append each group's protobuf bytes to the local archive, stamped with
+    the current time. Returns the number of snapshots appended.
+    """
+    archive = get_archive()
+    now = time.time()
+    count = 0
+    for group_key, snapshot in snapshots.items():
+        if _LAST_ARCHIVED.get(group_key) == snapshot["digest"]:
+            continue
+        archive.append(group_key, snapshot["blob"], now)
+        _LAST_ARCHIVED[group_key] = snapshot["digest"]
+        count += 1
+    if not WRITE_DB:
+        _remember_seen(snapshots)
+    return count
+
+
+def insert_raw_blobs(conn, snapshots: dict) -> int:
+    """
+    Compress each group's protobuf bytes (or its delta, in delta mode) with
+    CODEC and store all of them in the 'raw' table in one transaction, keyed
+    by the hash of the raw bytes. Newly inserted snapshots are also decoded
+    into trip_updates in the same transaction.
+
+    Returns the number of rows actually inserted (duplicates are skipped).
+    """
+    if not snapshots:
+        return 0
+
+    dictionary = blob_codecs.load_dictionary(conn, CODEC_DICT_ID)
+    tag_codec = CODEC != blob_codecs.DEFAULT_CODEC or CODEC_DICT_ID is not None
+
+    columns = ["data", "data_hash", "route_group"]
+    if STORAGE_MODE == "delta":
+        columns += ["storage", "base_id"]
+    if tag_codec:
+        columns += ["codec", "codec_dict_id"]
+
+    rows = []
+    storages = {}
+    for group_key, snapshot in snapshots.items():
+        payload, storage, base_id = _encode_row(group_key, snapshot)
+        storages[group_key] = storage
+        compressed = blob_codecs.compress(payload, CODEC, dictionary)
         # psycopg2.Binary tells psycopg2 this is binary (BYTEA) data
-        cur.execute(sql, (psycopg2.Binary(compressed), data_hash, route_group))
+        row = (psycopg2.Binary(compressed), snapshot["digest"], group_key)
+        if STORAGE_MODE == "delta":
+            row += (storage, base_id)
+        if tag_codec:
+            row += (CODEC, CODEC_DICT_ID)
+        rows.append(row)
+
+    sql = f"""
+        INSERT INTO raw ({", ".join(columns)})
+        VALUES %s
+        ON CONFLICT (data_hash) DO NOTHING
+        RETURNING id, route_group;
+    """
+
+    with conn.cursor() as cur:
+        inserted = psycopg2.extras.execute_values(cur, sql, rows, fetch=True)
+        if DECODE_TRIP_UPDATES and inserted:
+            copy_trip_updates(cur, {
+                row_id: snapshots[group_key]["blob"]
+                for row_id, group_key in inserted
+            })
     conn.commit()
 
+    # Only remember snapshots once they are safely stored.
+    _remember_seen(snapshots)
+    if STORAGE_MODE == "delta":
+        for row_id, group_key in inserted:
+            last = _LAST_STORED.get(group_key)
+            full = storages[group_key] == "full"
+            _LAST_STORED[group_key] = {
+                "id": row_id,
+                "blob": snapshots[group_key]["blob"],
+                "deltas": 0 if full else last["deltas"] + 1,
+            }
+    return len(inserted)
+
+
+def ingest_once(conn, session):
+    """
+    One ingest cycle: fetch all groups in parallel, then one batched insert
+    (and/or an append to the local archive, per RAW_SINK).
+    """
+    start = time.perf_counter()
+    snapshots = fetch_all(session)
+    fetched = time.perf_counter()
+
+    archived = archive_snapshots(snapshots) if WRITE_ARCHIVE else 0
+    inserted = insert_raw_blobs(conn, snapshots) if WRITE_DB else 0
+    done = time.perf_counter()
+
     print(
-        f"[{route_group}] compressed={len(compressed)} bytes, "
-        f"hash={data_hash}, inserted (or skipped duplicate)"
+        f"cycle: {len(snapshots)}/{len(ROUTE_GROUPS)} groups changed, fetched in "
+        f"{(fetched - start) * 1000:.0f} ms, inserted {inserted} new rows"
+        f"{f' and archived {archived}' if WRITE_ARCHIVE else ''} in "
+        f"{(done - fetched) * 1000:.0f} ms, total {(done - start) * 1000:.0f} ms"
     )
+    return inserted if WRITE_DB else archived
 
 
 def main():
-    conn = get_connection()
+    conn = get_connection() if WRITE_DB else None
+    session = get_session()
     try:
-        for group_key in ROUTE_GROUPS.keys():
-            print(f"Fetching group: {group_key}")
-            raw_bytes = fetch_feed(group_key)
-            insert_raw_blob(conn, raw_bytes, group_key)
+        ingest_once(conn, session)
     finally:
-        conn.close()
+        session.close()
+        if conn is not None:
+            conn.close()
 
 
 if __name__ == "__main__":
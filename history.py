@@ -0,0 +1,187 @@
+#!/usr/bin/env python3
+"""
+Historical arrivals decoded from the stored snapshots in `raw`.
+
+A time range can cover thousands of snapshots, so stream_arrivals() never
+holds more than a few of them at once:
+
+  - rows come off a server-side (named) cursor FETCH_SIZE at a time;
+  - decompressing + parsing (the expensive part) fans out over a shared
+    process pool, at most MAX_PENDING tasks in flight per request;
+  - each task returns its arrivals already encoded as NDJSON lines, which
+    are yielded in snapshot order as soon as they are ready.
+
+A task is a run of consecutive rows that starts at a full snapshot (or at a
+delta whose base is looked up first), so delta rows (snapshot_store.py) are
+rebuilt inside the worker from the previous snapshot in the same task. A
+delta whose base is not the row before it starts a new task at that base.
+"""
+import json
+import os
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+
+from google.transit import gtfs_realtime_pb2 as gtfs
+
+import blob_codecs
+import snapshot_store
+from feed_time import epoch_to_time
+
+HISTORY_WORKERS = int(os.environ.get("HISTORY_WORKERS") or os.cpu_count() or 1)
+FETCH_SIZE = 50                    # rows per round trip of the named cursor
+TASK_SIZE = 8                      # full snapshots per decode task
+MAX_PENDING = HISTORY_WORKERS * 2  # decode tasks in flight per request
+
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+
+def _get_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            # forkserver: workers must not inherit the server's threads/locks.
+            # Preload only this module; the default re-imports __main__ (the
+            # server, with its feed cache, replay and static GTFS) in there.
+            ctx = multiprocessing.get_context("forkserver")
+            ctx.set_forkserver_preload(["history"])
+            _POOL = ProcessPoolExecutor(max_workers=HISTORY_WORKERS, mp_context=ctx)
+        return _POOL
+
+
+# ----------------------------
+#  Decoding (runs in the workers)
+# ----------------------------
+def snapshot_arrivals(blob, route_id=None, stop_ids=None):
+    """Arrivals in one snapshot, in the /route/<id>/arrivals format plus route_id."""
+    feed = gtfs.FeedMessage()
+    feed.ParseFromString(blob)
+
+    stop_filter = set(stop_ids or ())
+    arrivals = []
+    for ent in feed.entity:
+        if not ent.HasField("trip_update"):
+            continue
+        trip = ent.trip_update.trip
+        if route_id and trip.route_id != route_id:
+            continue
+
+        for stu in ent.trip_update.stop_time_update:
+            if not stu.stop_id or not stu.HasField("arrival"):
+                continue
+            if stop_filter and stu.stop_id not in stop_filter:
+                continue
+            arrivals.append({
+                "route_id": trip.route_id,
+                "trip_id": trip.trip_id,
+                "stop_id": stu.stop_id,
+                "arrival_epoch": stu.arrival.time,
+                "arrival_time": epoch_to_time(stu.arrival.time),
+            })
+    return feed.header.timestamp, arrivals
+
+
+def _decode_task(rows, base_id, base_blob, dictionaries, route_id, stop_ids):
+    """
+    rows: [(id, created_at, storage, codec, codec_dict_id, data, base_id)] in
+    order, the first delta's base being `base_id` / `base_blob`.
+    Returns the NDJSON lines for all of them as one bytes object.
+    """
+    out = []
+    prev_id, blob = base_id, base_blob
+    for row_id, created_at, storage, codec, dict_id, data, row_base in rows:
+        payload = blob_codecs.decompress(data, codec, dictionaries.get(dict_id))
+        if storage == "delta":
+            if row_base != prev_id:
+                raise ValueError(f"raw row {row_id} is a delta against {row_base}, not {prev_id}")
+            blob = snapshot_store.apply_delta(blob, payload)
+        else:
+            blob = payload
+        prev_id = row_id
+
+        feed_ts, arrivals = snapshot_arrivals(blob, route_id, stop_ids)
+        for arrival in arrivals:
+            arrival["snapshot_id"] = row_id
+            arrival["created_at"] = created_at
+            arrival["feed_timestamp"] = feed_ts
+            out.append(json.dumps(arrival, separators=(",", ":")))
+            out.append("\n")
+    return "".join(out).encode()
+
+
+# ----------------------------
+#  Streaming (runs in the request)
+# ----------------------------
+_RANGE_SQL = """
+    SELECT id, created_at, {storage}, {codec}, {codec_dict_id}, data, {base_id}
+    FROM raw
+    WHERE route_group = %s AND created_at >= %s AND created_at < %s
+    ORDER BY id;
+"""
+
+
+def _tasks(conn, cur):
+    """Yield (rows, base_id, base_blob, dictionaries) decode tasks from the cursor."""
+    rows = []
+    fulls = 0
+    prev_id = None
+    task_base, base_blob = None, None
+    dictionaries = {}
+    for row_id, created_at, storage, codec, dict_id, data, base_id in cur:
+        if storage == "full":
+            if fulls >= TASK_SIZE:
+                yield rows, task_base, base_blob, dictionaries
+                rows, fulls, task_base, base_blob, dictionaries = [], 0, None, None, {}
+            fulls += 1
+        elif prev_id != base_id:
+            # Range starts mid-chain, or the base is not the row before:
+            # start a task on the base, rebuilt from its keyframe.
+            if rows:
+                yield rows, task_base, base_blob, dictionaries
+                rows, fulls, dictionaries = [], 0, {}
+            task_base, base_blob = base_id, snapshot_store.load_snapshot(conn, base_id)
+
+        if dict_id is not None and dict_id not in dictionaries:
+            dictionaries[dict_id] = blob_codecs.load_dictionary(conn, dict_id)
+        rows.append((row_id, created_at.isoformat(), storage, codec, dict_id, bytes(data), base_id))
+        prev_id = row_id
+
+    if rows:
+        yield rows, task_base, base_blob, dictionaries
+
+
+def stream_arrivals(conn, route_group, start, end, route_id=None, stop_ids=None):
+    """
+    NDJSON chunks with every arrival in the `route_group` snapshots stored in
+    [start, end), oldest snapshot first. `conn` stays with the caller.
+    """
+    pool = _get_pool()
+    pending = deque()
+    try:
+        # Named cursor: Postgres keeps the result set, we pull FETCH_SIZE rows
+        # at a time. A second (client) cursor may run meanwhile for bases.
+        with conn.cursor(name="history_arrivals") as cur:
+            cur.itersize = FETCH_SIZE
+            cur.execute(
+                _RANGE_SQL.format(**snapshot_store.raw_columns(conn)),
+                (route_group, start, end),
+            )
+
+            for rows, base_id, base_blob, dictionaries in _tasks(conn, cur):
+                pending.append(pool.submit(
+                    _decode_task, rows, base_id, base_blob, dictionaries, route_id, stop_ids
+                ))
+                while len(pending) >= MAX_PENDING:
+                    chunk = pending.popleft().result()
+                    if chunk:
+                        yield chunk
+
+        while pending:
+            chunk = pending.popleft().result()
+            if chunk:
+                yield chunk
+    finally:
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,13 @@
+-- Keyframe + delta storage for raw feed snapshots (see snapshot_store.py).
+--
+-- storage = 'full'  : data is the whole compressed FeedMessage (keyframe)
+-- storage = 'delta' : data is a compressed delta against raw.base_id
+--
+-- Existing rows are all full snapshots, which is the column default.
+
+ALTER TABLE raw ADD COLUMN IF NOT EXISTS storage text NOT NULL DEFAULT 'full';
+ALTER TABLE raw ADD COLUMN IF NOT EXISTS base_id bigint REFERENCES raw (id);
+
+ALTER TABLE raw DROP CONSTRAINT IF EXISTS raw_storage_check;
+ALTER TABLE raw ADD CONSTRAINT raw_storage_check
+    CHECK (storage IN ('full', 'delta') AND (storage = 'full') = (base_id IS NULL));
@@ -0,0 +1,17 @@
+-- Per-row compression codec for raw.data (see blob_codecs.py).
+--
+-- codec         : 'gzip' (every existing row), 'zstd' or 'lz4'
+-- codec_dict_id : zstd dictionary the row was compressed with, if any
+
+CREATE TABLE IF NOT EXISTS codec_dicts (
+    id         serial PRIMARY KEY,
+    codec      text NOT NULL,
+    data       bytea NOT NULL,
+    created_at timestamptz NOT NULL DEFAULT now()
+);
+
+ALTER TABLE raw ADD COLUMN IF NOT EXISTS codec text NOT NULL DEFAULT 'gzip';
+ALTER TABLE raw ADD COLUMN IF NOT EXISTS codec_dict_id integer REFERENCES codec_dicts (id);
+
+-- recompress_raw.py walks the remaining gzip rows by id.
+CREATE INDEX IF NOT EXISTS raw_codec_id_idx ON raw (codec, id);
@@ -0,0 +1,24 @@
+-- Decoded stop time updates, one row per (snapshot, trip, stop), written by
+-- gtfs_ingest.py in the same transaction as the raw snapshot.
+--
+-- "What arrived at B06S between 8 and 9am last Tuesday":
+--   SELECT * FROM trip_updates
+--   WHERE route_id = 'F' AND stop_id = 'B06S'
+--     AND arrival BETWEEN '2026-10-13 08:00-04' AND '2026-10-13 09:00-04';
+
+CREATE TABLE IF NOT EXISTS trip_updates (
+    snapshot_id bigint NOT NULL REFERENCES raw (id) ON DELETE CASCADE,
+    route_id    text NOT NULL,
+    trip_id     text NOT NULL,
+    stop_id     text NOT NULL,
+    arrival     timestamptz,
+    departure   timestamptz,
+    feed_ts     timestamptz NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS trip_updates_route_stop_arrival_idx
+    ON trip_updates (route_id, stop_id, arrival);
+
+-- Cascading deletes from raw, and "everything in snapshot N".
+CREATE INDEX IF NOT EXISTS trip_updates_snapshot_idx
+    ON trip_updates (snapshot_id);
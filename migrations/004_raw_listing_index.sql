@@ -0,0 +1,37 @@
+-- Keyset pagination for GET /db/raw (serverAPI.py), served from an index
+-- alone.
+--
+-- size_bytes : octet_length(data), computed once on write, so the listing
+--              never reads the TOASTed blob. Adding it rewrites the table
+--              once.
+--
+-- The listing orders by (created_at, id) and pages with
+-- (created_at, id) < (cursor), filtered by route_group or not:
+--
+--   SELECT id, route_group, created_at, size_bytes FROM raw
+--   WHERE route_group = ANY('{ace}') AND (created_at, id) < ('2025-12-02 08:00', 1234)
+--   ORDER BY created_at DESC, id DESC LIMIT 100;
+--
+-- Both indexes INCLUDE the remaining listed columns, so either plan is an
+-- index-only scan (as long as autovacuum keeps the visibility map current).
+-- raw_group_created_idx also serves history.py's per-group time ranges.
+--
+-- Migrations may run inside a transaction, where VACUUM is not allowed, so
+-- this file only refreshes the statistics. Right after applying it, run
+-- once, on its own:
+--
+--   VACUUM raw;
+--
+-- so the visibility map is set and the new indexes answer the listing
+-- without heap fetches before autovacuum gets to the rewritten table.
+
+ALTER TABLE raw ADD COLUMN IF NOT EXISTS size_bytes integer
+    GENERATED ALWAYS AS (octet_length(data)) STORED;
+
+CREATE INDEX IF NOT EXISTS raw_group_created_idx
+    ON raw (route_group, created_at, id) INCLUDE (size_bytes);
+
+CREATE INDEX IF NOT EXISTS raw_created_idx
+    ON raw (created_at, id) INCLUDE (route_group, size_bytes);
+
+ANALYZE raw;
@@ -1,67 +1,270 @@
+#!/usr/bin/env python3
+"""
+Load the static GTFS (gtfs_subway/*.txt) into Postgres.
+
+Each file is streamed with COPY into a staging table, one connection per
+file and up to --jobs files in parallel. Indexes are built on the staging
+tables after the data is in (much faster than maintaining them row by row),
+then every table is swapped in with a rename inside one transaction, so
+readers see either the old GTFS or the new one, never a half-loaded or mixed
+set of tables.
+
+Staging tables copy the columns, defaults and check constraints of the live
+table (CREATE TABLE ... LIKE); a table that does not exist yet is created
+with text columns named after the CSV header. Its primary key, unique
+constraints and any other indexes are recreated on the staging table after
+the COPY, and its table grants are re-applied at the swap. Foreign keys,
+column grants, triggers and policies are not carried over, and views or
+foreign keys that depend on a live table make the swap fail (nothing is
+replaced then): drop them before loading and recreate them after.
+
+Usage:
+    python3 neondb.py [--dir gtfs_subway] [--jobs 4] [--database-url URL]
+                      [file.txt ...]
+"""
 import os
 import csv
+import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
 import psycopg
+from psycopg import sql
 from dotenv import load_dotenv
 
-# Load DATABASE_URL from .env
-load_dotenv()
-conn_string = os.getenv("NEON_DATABASE_URL")
-if not conn_string:
-    raise RuntimeError("Please set DATABASE_URL in .env")
-
 GTFS_FOLDER = "./gtfs_subway"
+GTFS_FILES = [
+    "agency.txt",
+    "calendar.txt",
+    "calendar_dates.txt",
+    "routes.txt",
+    "shapes.txt",
+    "stop_times.txt",
+    "stops.txt",
+    "transfers.txt",
+    "trips.txt",
+]
+COPY_CHUNK = 1024 * 1024  # bytes per COPY write
+
+# table -> indexes (column lists) built after loading, matching the lookups
+# the servers make (iqra-server.py, static_gtfs.py).
+INDEXES = {
+    "agency": [["agency_id"]],
+    "calendar": [["service_id"]],
+    "calendar_dates": [["service_id", "date"]],
+    "routes": [["route_id"]],
+    "shapes": [["shape_id", "shape_pt_sequence"]],
+    "stop_times": [["trip_id", "stop_sequence"], ["stop_id"]],
+    "stops": [["stop_id"]],
+    "transfers": [["from_stop_id"], ["to_stop_id"]],
+    "trips": [["trip_id"], ["route_id"], ["service_id"]],
+}
+
+
+def _staging(table):
+    return f"{table}__staging"
+
+
+def _index_name(table, columns):
+    return f"{table}_{'_'.join(columns)}_idx"
+
+
+def _copy_indexes(cur, table, staging):
+    """
+    Recreate the primary key, unique/exclusion constraints and other indexes
+    of `table` on `staging`, named <name>__staging. The INDEXES ones are
+    built separately.
+    """
+    cur.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) AND contype IN ('p', 'u', 'x')",
+        (table,),
+    )
+    for name, definition in cur.fetchall():
+        cur.execute(sql.SQL("ALTER TABLE {} ADD CONSTRAINT {} {}").format(
+            sql.Identifier(staging), sql.Identifier(_staging(name)), sql.SQL(definition)
+        ))
+
+    own = {_index_name(table, columns) for columns in INDEXES.get(table, [])}
+    cur.execute(
+        "SELECT c.relname, i.indisunique, pg_get_indexdef(i.indexrelid) "
+        "FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+        "WHERE i.indrelid = to_regclass(%s) AND NOT EXISTS ("
+        "  SELECT 1 FROM pg_constraint k"
+        "  WHERE k.conrelid = i.indrelid AND k.conindid = i.indexrelid)",
+        (table,),
+    )
+    for name, unique, definition in cur.fetchall():
+        if name in own:
+            continue
+        # "CREATE INDEX <name> ON <table> USING ...": keep everything from USING.
+        cur.execute(sql.SQL("CREATE {}INDEX {} ON {} USING {}").format(
+            sql.SQL("UNIQUE " if unique else ""),
+            sql.Identifier(_staging(name)),
+            sql.Identifier(staging),
+            sql.SQL(definition.split(" USING ", 1)[1]),
+        ))
+
 
+def _copy_grants(cur, table, staging):
+    """Grant on `staging` every table privilege granted on `table`."""
+    cur.execute(
+        "SELECT a.privilege_type, a.is_grantable, r.rolname "
+        "FROM pg_class c CROSS JOIN LATERAL aclexplode(c.relacl) a "
+        "LEFT JOIN pg_roles r ON r.oid = a.grantee "
+        "WHERE c.oid = to_regclass(%s)",
+        (table,),
+    )
+    for privilege, grantable, role in cur.fetchall():
+        cur.execute(sql.SQL("GRANT {} ON {} TO {}{}").format(
+            sql.SQL(privilege),
+            sql.Identifier(staging),
+            sql.Identifier(role) if role else sql.SQL("PUBLIC"),
+            sql.SQL(" WITH GRANT OPTION" if grantable else ""),
+        ))
 
-def load_gtfs_file(filename, conn):
-    table_name = filename.replace(".txt", "")  # e.g. agency.txt → agency
-    file_path = os.path.join(GTFS_FOLDER, filename)
 
-    print(f"\nLoading {filename} into table '{table_name}' ...")
+def get_header_columns(file_path):
+    """Read the first row to get column names."""
+    with open(file_path, newline="", encoding="utf-8-sig") as f:
+        return next(csv.reader(f))
 
-    # Read CSV
-    with open(file_path, newline="", encoding="utf-8") as csvfile:
-        reader = csv.DictReader(csvfile)
-        columns = reader.fieldnames
 
-        if not columns:
-            print(f"Skipping {filename}, no columns found.")
-            return
+def load_staging(conn_string, file_path):
+    """
+    COPY one GTFS file into <table>__staging and index it.
+    Returns (table, rows, bytes, copy seconds, index seconds).
+    """
+    table = os.path.basename(file_path).replace(".txt", "")
+    staging = _staging(table)
+    columns = get_header_columns(file_path)
+
+    with psycopg.connect(conn_string) as conn:
+        with conn.cursor() as cur:
+            cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(staging)))
+            cur.execute("SELECT to_regclass(%s)", (table,))
+            exists = cur.fetchone()[0] is not None
+            if exists:
+                # Indexes (primary key and unique constraints included) come
+                # after the COPY, see _copy_indexes.
+                cur.execute(sql.SQL(
+                    "CREATE TABLE {} (LIKE {} INCLUDING ALL EXCLUDING INDEXES)"
+                ).format(sql.Identifier(staging), sql.Identifier(table)))
+            else:
+                cur.execute(sql.SQL("CREATE TABLE {} ({})").format(
+                    sql.Identifier(staging),
+                    sql.SQL(", ").join(
+                        sql.SQL("{} text").format(sql.Identifier(c)) for c in columns
+                    ),
+                ))
+
+            start = time.perf_counter()
+            size = 0
+            copy_sql = sql.SQL(
+                "COPY {} ({}) FROM STDIN WITH (FORMAT csv, HEADER true)"
+            ).format(
+                sql.Identifier(staging),
+                sql.SQL(", ").join(map(sql.Identifier, columns)),
+            )
+            with open(file_path, "rb") as f, cur.copy(copy_sql) as copy:
+                for chunk in iter(lambda: f.read(COPY_CHUNK), b""):
+                    copy.write(chunk)
+                    size += len(chunk)
+            rows = cur.rowcount
+            copied = time.perf_counter()
+
+            if exists:
+                _copy_indexes(cur, table, staging)
+            for index_columns in INDEXES.get(table, []):
+                if not set(index_columns) <= set(columns):
+                    continue
+                cur.execute(sql.SQL("CREATE INDEX {} ON {} ({})").format(
+                    sql.Identifier(_index_name(staging, index_columns)),
+                    sql.Identifier(staging),
+                    sql.SQL(", ").join(map(sql.Identifier, index_columns)),
+                ))
+            cur.execute(sql.SQL("ANALYZE {}").format(sql.Identifier(staging)))
+        conn.commit()
+
+    return table, rows, size, copied - start, time.perf_counter() - copied
 
-        columns_sql = ", ".join(columns)
-        placeholders = ", ".join(["%s"] * len(columns))
-        insert_sql = f"INSERT INTO {table_name} ({columns_sql}) VALUES ({placeholders})"
 
+def swap_tables(conn_string, tables):
+    """Replace every live table by its staging copy in one transaction."""
+    with psycopg.connect(conn_string) as conn:
         with conn.cursor() as cur:
-            for row in reader:
-                values = [row.get(col) for col in columns]
+            for table in tables:
+                staging = _staging(table)
+                _copy_grants(cur, table, staging)
                 try:
-                    cur.execute(insert_sql, values)
-                except Exception as e:
-                    print(f"Error inserting row {row}: {e}")
+                    cur.execute(sql.SQL("DROP TABLE IF EXISTS {}").format(sql.Identifier(table)))
+                except psycopg.errors.DependentObjectsStillExist as e:
+                    raise RuntimeError(
+                        f"Cannot replace {table}: other objects depend on it ({e.diag.message_detail}). "
+                        "Drop them before loading and recreate them after."
+                    ) from e
+                cur.execute(sql.SQL("ALTER TABLE {} RENAME TO {}").format(
+                    sql.Identifier(staging), sql.Identifier(table)
+                ))
+                for index_columns in INDEXES.get(table, []):
+                    cur.execute(sql.SQL("ALTER INDEX IF EXISTS {} RENAME TO {}").format(
+                        sql.Identifier(_index_name(staging, index_columns)),
+                        sql.Identifier(_index_name(table, index_columns)),
+                    ))
 
-        print(f"✓ Finished loading {filename}")
+                # Indexes and constraints from _copy_indexes get their old
+                # names back (renaming a constraint's index renames both).
+                cur.execute(
+                    "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                    "WHERE i.indrelid = to_regclass(%s)",
+                    (table,),
+                )
+                for (name,) in cur.fetchall():
+                    if name.endswith(_staging("")):
+                        cur.execute(sql.SQL("ALTER INDEX {} RENAME TO {}").format(
+                            sql.Identifier(name), sql.Identifier(name[:-len(_staging(""))])
+                        ))
+        conn.commit()
 
 
 def main():
-    # List of GTFS files to load
-    gtfs_files = [
-        "agency.txt",
-        "calendar.txt",
-        "calendar_dates.txt",
-        "routes.txt",
-        "shapes.txt",
-        "stop_times.txt",
-        "stops.txt",
-        "transfers.txt",
-        "trips.txt",
-    ]
+    load_dotenv()
 
-    with psycopg.connect(conn_string) as conn:
-        for filename in gtfs_files:
-            load_gtfs_file(filename, conn)
+    parser = argparse.ArgumentParser(description="Load static GTFS into Postgres with COPY")
+    parser.add_argument("files", nargs="*", help=f"GTFS files to load (default: {' '.join(GTFS_FILES)})")
+    parser.add_argument("--dir", default=GTFS_FOLDER, help="folder with the GTFS .txt files")
+    parser.add_argument("--jobs", type=int, default=4, help="files loaded in parallel")
+    parser.add_argument("--database-url", default=os.getenv("NEON_DATABASE_URL"))
+    args = parser.parse_args()
 
-        conn.commit()
-        print("\nALL GTFS FILES LOADED SUCCESSFULLY!")
+    if not args.database_url:
+        raise RuntimeError("Please set NEON_DATABASE_URL in .env or pass --database-url")
+
+    paths = []
+    for filename in args.files or GTFS_FILES:
+        path = os.path.join(args.dir, filename)
+        if os.path.exists(path):
+            paths.append(path)
+        else:
+            print(f"Skipping {filename}: not found in {args.dir}")
+
+    start = time.perf_counter()
+    # Biggest files first so they are not the last ones still running.
+    paths.sort(key=os.path.getsize, reverse=True)
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        futures = [pool.submit(load_staging, args.database_url, p) for p in paths]
+        loaded = []
+        for future in futures:
+            table, rows, size, copy_s, index_s = future.result()
+            loaded.append(table)
+            print(
+                f"{table:<16} {rows:>9} rows {size / 1e6:>8.2f} MB  "
+                f"copy {copy_s:6.2f}s ({size / 1e6 / max(copy_s, 1e-9):7.2f} MB/s, "
+                f"{rows / max(copy_s, 1e-9):9.0f} rows/s)  indexes {index_s:5.2f}s"
+            )
+
+    swap_tables(args.database_url, loaded)
+    print(f"\nSwapped in {len(loaded)} tables in {time.perf_counter() - start:.2f}s total")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Background job: recompress old gzip rows of the `raw` table with another
+codec (see blob_codecs.py). Needs migrations/001_raw_delta_storage.sql
+(dictionary training samples rows with storage = 'full') and
+002_raw_codecs.sql.
+
+Only raw.data and its codec columns change; the decompressed payload (a full
+snapshot or a delta, see snapshot_store.py) and raw.data_hash stay the same,
+so /db/raw/<id>/protobuf_raw returns identical bytes before and after.
+
+Rows are processed in id order, BATCH_SIZE per transaction, so the job can be
+stopped and restarted at any time.
+
+Usage:
+    # train a zstd dictionary on recent snapshots and store it in codec_dicts
+    python3 recompress_raw.py train [--samples 500]
+
+    # recompress gzip rows older than a day with zstd + that dictionary
+    python3 recompress_raw.py recompress --codec zstd --dict-id 1 [--min-age-hours 24]
+"""
+import argparse
+import time
+
+import psycopg2
+import psycopg2.extras
+
+import blob_codecs
+import gtfs_ingest
+
+BATCH_SIZE = 200
+
+
+def train(conn, samples):
+    """Train a zstd dictionary on the newest full snapshots and store it."""
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT data, codec, codec_dict_id FROM raw
+            WHERE storage = 'full'
+            ORDER BY id DESC
+            LIMIT %s;
+            """,
+            (samples,),
+        )
+        rows = cur.fetchall()
+    if not rows:
+        raise RuntimeError("No full snapshots to train on")
+
+    blobs = [
+        blob_codecs.decompress_row(conn, data, codec, dict_id)
+        for data, codec, dict_id in rows
+    ]
+    dictionary = blob_codecs.train_dictionary(blobs)
+    dict_id = blob_codecs.store_dictionary(conn, dictionary)
+    conn.commit()
+    print(f"Trained {len(dictionary)}-byte dictionary on {len(blobs)} snapshots: id {dict_id}")
+    return dict_id
+
+
+def recompress(conn, codec, dict_id=None, min_age_hours=24, limit=None):
+    """Recompress gzip rows older than `min_age_hours`. Returns the row count."""
+    dictionary = blob_codecs.load_dictionary(conn, dict_id)
+    done = 0
+    before = after = 0
+    last_id = 0
+    start = time.perf_counter()
+
+    while limit is None or done < limit:
+        batch = BATCH_SIZE if limit is None else min(BATCH_SIZE, limit - done)
+        with conn.cursor() as cur:
+            cur.execute(
+                """
+                SELECT id, data FROM raw
+                WHERE codec = 'gzip' AND codec_dict_id IS NULL AND id > %s
+                  AND created_at < now() - %s * interval '1 hour'
+                ORDER BY id
+                LIMIT %s;
+                """,
+                (last_id, min_age_hours, batch),
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+
+            updates = []
+            for row_id, data in rows:
+                payload = blob_codecs.decompress(data)
+                compressed = blob_codecs.compress(payload, codec, dictionary)
+                updates.append((row_id, psycopg2.Binary(compressed), codec, dict_id))
+                before += len(data)
+                after += len(compressed)
+
+            psycopg2.extras.execute_values(
+                cur,
+                """
+                UPDATE raw
+                SET data = v.data, codec = v.codec, codec_dict_id = v.dict_id
+                FROM (VALUES %s) AS v (id, data, codec, dict_id)
+                WHERE raw.id = v.id;
+                """,
+                updates,
+                template="(%s, %s, %s, %s::integer)",
+            )
+        conn.commit()
+
+        done += len(rows)
+        last_id = rows[-1][0]
+        print(f"recompressed {done} rows (up to id {last_id})", flush=True)
+
+    elapsed = time.perf_counter() - start
+    if done:
+        print(
+            f"{done} rows: {before} -> {after} bytes "
+            f"({after / before:.1%}) in {elapsed:.1f}s"
+        )
+    return done
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Recompress stored feed blobs")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_train = sub.add_parser("train", help="train and store a zstd dictionary")
+    p_train.add_argument("--samples", type=int, default=500)
+
+    p_run = sub.add_parser("recompress", help="recompress old gzip rows")
+    p_run.add_argument("--codec", default="zstd", choices=sorted(blob_codecs.CODECS))
+    p_run.add_argument("--dict-id", type=int, default=None)
+    p_run.add_argument("--min-age-hours", type=float, default=24)
+    p_run.add_argument("--limit", type=int, default=None)
+
+    args = parser.parse_args()
+
+    conn = gtfs_ingest.get_connection()
+    try:
+        if args.command == "train":
+            train(conn, args.samples)
+        else:
+            recompress(conn, args.codec, args.dict_id, args.min_age_hours, args.limit)
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,102 @@
 #!/usr/bin/env python3
+"""
+Long-running ingest daemon.
 
+Runs gtfs_ingest.ingest_once() in-process every INTERVAL seconds, keeping
+the Postgres connection and the MTA HTTP session warm between cycles.
+
+- Fixed-rate schedule: cycles start at t0, t0 + 30s, t0 + 60s, ... no matter
+  how long each ingest takes. Ticks that were missed because a cycle overran
+  are skipped rather than run back to back.
+- On errors the connection is reset and the next attempt backs off
+  exponentially (capped at MAX_BACKOFF), then the schedule resumes.
+- SIGINT / SIGTERM finish the current cycle and exit cleanly.
+
+Usage:
+    python3 scheduled_polling.py [--interval SECONDS] [--duration SECONDS]
+"""
+import argparse
+import signal
+import threading
 import time
-import subprocess
-import sys
-from datetime import datetime, timedelta
+from datetime import datetime
 
+import gtfs_ingest
 
-def run_ingest():
-    """Run store_data.py as a subprocess and print its output."""
-    try:
-        result = subprocess.run(
-            [sys.executable, "gtfs_ingest.py"],
-            capture_output=True,
-            text=True,
-            check=False
-        )
-        print("=== store_data.py output ===")
-        print(result.stdout)
-        print(result.stderr)
-        print("============================")
+INTERVAL = 30       # seconds between cycle starts
+MAX_BACKOFF = 300   # seconds, upper bound on the retry delay after failures
 
-    except Exception as e:
-        print("Error running store_data.py:", e)
+_stop = threading.Event()
 
 
-def main():
-    INTERVAL = 30              # seconds
-    DURATION = 2 * 60 * 60     # 2 hours (in seconds)
+def _request_stop(signum, frame):
+    print(f"\nReceived signal {signum}, stopping after the current cycle...")
+    _stop.set()
+
+
+def _log(msg):
+    print(f"[{datetime.now().strftime('%H:%M:%S')}] {msg}", flush=True)
+
 
-    print("Starting 2-hour execution loop...")
-    end_time = datetime.now() + timedelta(seconds=DURATION)
+def run(interval=INTERVAL, duration=None):
+    session = gtfs_ingest.get_session()
+    conn = None
+    failures = 0
 
-    while datetime.now() < end_time:
-        now = datetime.now().strftime("%H:%M:%S")
-        print(f"\n[{now}] Running gtfs_ingest.py ...")
+    start = time.monotonic()
+    end = start + duration if duration else None
+    next_run = start
 
-        run_ingest()
+    try:
+        while not _stop.is_set():
+            try:
+                if gtfs_ingest.WRITE_DB and (conn is None or conn.closed):
+                    conn = gtfs_ingest.get_connection()
+                gtfs_ingest.ingest_once(conn, session)
+                failures = 0
+            except Exception as e:
+                failures += 1
+                _log(f"ingest failed ({failures} in a row): {e}")
+                if conn is not None:
+                    conn.close()
+                    conn = None
+
+            now = time.monotonic()
+            if failures:
+                next_run = now + min(interval * 2 ** (failures - 1), MAX_BACKOFF)
+            else:
+                next_run += interval
+                if next_run <= now:
+                    skipped = int((now - next_run) // interval) + 1
+                    _log(f"cycle overran, skipping {skipped} tick(s)")
+                    next_run += skipped * interval
+
+            if end is not None and next_run >= end:
+                break
+            _stop.wait(next_run - time.monotonic())
+    finally:
+        session.close()
+        if conn is not None:
+            conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GTFS-realtime ingest daemon")
+    parser.add_argument("--interval", type=float, default=INTERVAL)
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=None,
+        help="stop after this many seconds (default: run until signalled)",
+    )
+    args = parser.parse_args()
 
-        time.sleep(INTERVAL)
+    signal.signal(signal.SIGINT, _request_stop)
+    signal.signal(signal.SIGTERM, _request_stop)
 
-    print("\nFinished running for 2 hours.")
+    _log(f"Starting ingest daemon, every {args.interval:g}s")
+    run(args.interval, args.duration)
+    _log("Ingest daemon stopped.")
 
 
 if __name__ == "__main__":
@@ -1,67 +1,14 @@
-from google.transit import gtfs_realtime_pb2
-from flask import Flask, request, abort
-import time
-import requests
+from flask import Flask, Response, request, abort
 import datetime
-import threading
 
-app = Flask(__name__)
-
-_GTFS_CACHE = {}
-_GTFS_CACHE_LOCK = threading.Lock()
-
-# Minimum seconds between requests to the same feed
-MIN_REFRESH_INTERVAL = 10
-
-def get_feed(url):
-    now = time.time()
-
-    with _GTFS_CACHE_LOCK:
-        # If feed cached and still fresh → return cached copy
-        if url in _GTFS_CACHE:
-            last_ts = _GTFS_CACHE[url]["timestamp"]
-            if now - last_ts < MIN_REFRESH_INTERVAL:
-                return _GTFS_CACHE[url]["feed"]
-
-    feed = gtfs_realtime_pb2.FeedMessage()
-
-    response = requests.get(url)
-    response.raise_for_status()
-
-    feed.ParseFromString(response.content)
+from feed_cache import build_feed_url, get_entry, get_feed, get_arrivals_json, stats
+import arrivals_stream
+import arrivals_enrich
 
-    # Update cache
-    with _GTFS_CACHE_LOCK:
-        _GTFS_CACHE[url] = {
-            "timestamp": now,
-            "feed": feed,
-        }
-    return feed
-
-def epoch_to_time(ts):
-    return datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S")
-
-
-def build_feed_url(route_id):
-    url = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs"
+app = Flask(__name__)
 
-    match route_id:
-        case "A" | "C" | "E":
-            return url + "-ace"
-        case "B" | "D" | "F" | "M":
-            return url + "-bdfm"
-        case "G":
-            return url + "-g"
-        case "J" | "Z":
-            return url + "-jz"
-        case "N" | "Q" | "R" | "W":
-            return url + "-nqrw"
-        case "L":
-            return url + "-l"
-        case "1" | "2" | "3" | "4" | "5" | "6" | "7" | "S":
-            return url
-        case _:
-            return None
+# Static stop / trip / route details for ?enrich=1, built once up front.
+arrivals_enrich.load()
 
 
 @app.route("/route/<route_id>/feed")
@@ -81,42 +28,40 @@ def arrivals(route_id):
     if url is None:
         abort(400, description="Unsupported route_id")
 
-    feed = get_feed(url)
     stop_ids = request.args.getlist("stop_id")
+    enrich = request.args.get("enrich") in ("1", "true")
 
-    arrivals = []
+    body, version = get_arrivals_json(url, route_id, stop_ids, enrich)
 
-    for entity in feed.entity:
-        if not entity.HasField("trip_update"):
-            continue
+    # The body only changes when the feed does, so clients can revalidate.
+    response = Response(body, mimetype="application/json")
+    response.set_etag(str(version))
+    response.last_modified = datetime.datetime.fromtimestamp(
+        version, datetime.timezone.utc
+    )
+    return response.make_conditional(request)
 
-        trip = entity.trip_update.trip
 
-        # Filter out route ID
-        if trip.route_id != route_id:
-            continue
+@app.route("/route/<route_id>/arrivals/stream")
+def arrivals_stream_sse(route_id):
+    url = build_feed_url(route_id)
 
-        for stu in entity.trip_update.stop_time_update:
-            if not stu.HasField("stop_id"):
-                continue
+    if url is None:
+        abort(400, description="Unsupported route_id")
 
-            # Filter out stop IDs
-            if len(stop_ids) != 0 and stu.stop_id not in stop_ids:
-                continue
+    get_entry(url)
+    stop_ids = request.args.getlist("stop_id")
 
-            if stu.HasField("arrival"):
-                arrivals.append(
-                    {
-                        "trip_id": trip.trip_id,
-                        "stop_id": stu.stop_id,
-                        "arrival_epoch": stu.arrival.time,
-                        "arrival_time": epoch_to_time(stu.arrival.time),
-                    }
-                )
+    return Response(
+        arrivals_stream.stream(url, route_id, stop_ids),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
-    arrivals.sort(key=lambda x: (x["stop_id"], x["arrival_epoch"]))
 
-    return arrivals
+@app.route("/cache/stats")
+def cache_stats():
+    return stats()
 
 
 if __name__ == "__main__":
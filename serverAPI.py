@@ -3,17 +3,21 @@ from dotenv import load_dotenv
 load_dotenv(".env")
 
 import os
-import time
 import datetime
-import threading
 import psycopg2
 import psycopg2.extras
-import requests
-import gzip
 import base64
 
 from flask import Flask, request, abort, jsonify, Response
-from google.transit import gtfs_realtime_pb2 as gtfs
+
+import feed_cache
+import arrivals_stream
+import arrivals_enrich
+import snapshot_store
+import blob_codecs
+import snapshot_export
+import history
+import db_pool
 
 # ----------------------------
 #  Flask App
@@ -25,69 +29,31 @@ app = Flask(__name__)
 # ----------------------------
 DATABASE_URL = os.environ.get("DATABASE_URL")
 
-def get_db():
-    return psycopg2.connect(DATABASE_URL)
-
-# ----------------------------
-#  In-memory GTFS Cache
-# ----------------------------
-_GTFS_CACHE = {}
-_GTFS_CACHE_LOCK = threading.Lock()
-MIN_REFRESH_INTERVAL = 10  # seconds
-
-# ----------------------------
-#  Feed URL Builder
-# ----------------------------
-BASE_URL = "https://api-endpoint.mta.info/Dataservice/mtagtfsfeeds/nyct%2Fgtfs"
-
-def build_feed_url(route_id):
-    match route_id:
-        case "A" | "C" | "E":
-            return BASE_URL + "-ace"
-        case "B" | "D" | "F" | "M":
-            return BASE_URL + "-bdfm"
-        case "G":
-            return BASE_URL + "-g"
-        case "J" | "Z":
-            return BASE_URL + "-jz"
-        case "N" | "Q" | "R" | "W":
-            return BASE_URL + "-nqrw"
-        case "L":
-            return BASE_URL + "-l"
-        case "1" | "2" | "3" | "4" | "5" | "6" | "7" | "S":
-            return BASE_URL
-        case _:
-            return None
-
-# ----------------------------
-#  Fetch + Cache Live Feed
-# ----------------------------
-def get_live_feed(url):
-    now = time.time()
-
-    with _GTFS_CACHE_LOCK:
-        if url in _GTFS_CACHE:
-            last_ts = _GTFS_CACHE[url]["ts"]
-            if now - last_ts < MIN_REFRESH_INTERVAL:
-                return _GTFS_CACHE[url]["feed"]
+# Shared by every request thread (see db_pool.py); opened on first use.
+_DB_POOL = db_pool.ConnectionPool(DATABASE_URL)
 
-    resp = requests.get(url)
-    resp.raise_for_status()
+def get_db():
+    return _DB_POOL.getconn()
 
-    blob = resp.content
-    feed = gtfs.FeedMessage()
-    feed.ParseFromString(blob)
+def put_db(conn):
+    _DB_POOL.putconn(conn)
 
-    with _GTFS_CACHE_LOCK:
-        _GTFS_CACHE[url] = {"ts": now, "feed": feed}
 
-    return feed
+@app.errorhandler(db_pool.PoolTimeout)
+def db_pool_timeout(e):
+    return jsonify({"error": str(e)}), 503
 
 # ----------------------------
-#  Helpers
+#  Live Feed (served from memory, see feed_cache.py)
 # ----------------------------
-def epoch_to_time(ts):
-    return datetime.datetime.fromtimestamp(ts).strftime("%H:%M:%S")
+build_feed_url = feed_cache.build_feed_url
+get_live_feed = feed_cache.get_feed
+
+# Static stop / trip / route details for ?enrich=1, built once up front
+# (not in history.py's decode workers, which re-import this module as
+# __mp_main__ when it is run directly).
+if __name__ != "__mp_main__":
+    arrivals_enrich.load()
 
 # ----------------------------
 #  EXISTING ENDPOINTS
@@ -108,40 +74,95 @@ def route_arrivals(route_id):
     if not url:
         abort(400, "Invalid route_id")
 
-    feed = get_live_feed(url)
     stop_filter = request.args.getlist("stop_id")
+    enrich = request.args.get("enrich") in ("1", "true")
+    body, version = feed_cache.get_arrivals_json(url, route_id, stop_filter, enrich)
+
+    # Identical until the next feed refresh: let clients revalidate with
+    # If-None-Match / If-Modified-Since and get a 304.
+    resp = Response(body, mimetype="application/json")
+    resp.set_etag(str(version))
+    resp.last_modified = datetime.datetime.fromtimestamp(
+        version, datetime.timezone.utc
+    )
+    return resp.make_conditional(request)
 
-    arrivals = []
-    for ent in feed.entity:
-        if not ent.HasField("trip_update"):
-            continue
-
-        trip = ent.trip_update.trip
-        if trip.route_id != route_id:
-            continue
-
-        for stu in ent.trip_update.stop_time_update:
-            if not stu.HasField("stop_id"):
-                continue
-            if stop_filter and stu.stop_id not in stop_filter:
-                continue
-            if stu.HasField("arrival"):
-                arrivals.append(
-                    {
-                        "trip_id": trip.trip_id,
-                        "stop_id": stu.stop_id,
-                        "arrival_epoch": stu.arrival.time,
-                        "arrival_time": epoch_to_time(stu.arrival.time),
-                    }
-                )
-
-    arrivals.sort(key=lambda x: (x["stop_id"], x["arrival_epoch"]))
-    return jsonify(arrivals)
+
+@app.route("/route/<route_id>/arrivals/stream")
+def route_arrivals_stream(route_id):
+    """Server-Sent Events: a snapshot, then diffs on every feed change."""
+    url = build_feed_url(route_id)
+    if not url:
+        abort(400, "Invalid route_id")
+
+    feed_cache.get_entry(url)  # surface a failed first fetch as a 500
+    stop_filter = request.args.getlist("stop_id")
+    return Response(
+        arrivals_stream.stream(url, route_id, stop_filter),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@app.route("/cache/stats")
+def cache_stats():
+    """Live feed cache counters: real fetches vs. coalesced waits."""
+    return jsonify(feed_cache.stats())
 
 # ----------------------------
 #  NEW ENDPOINTS: DATABASE ACCESS
 # ----------------------------
 
+# Listing pages are keyed on (created_at, id); the cursor handed back in
+# X-Next-Cursor is that pair, base64'd so clients treat it as opaque.
+MAX_LIST_LIMIT = 1000
+
+
+def _encode_cursor(created_at, row_id):
+    raw = f"{created_at.isoformat()},{row_id}".encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+
+def _decode_cursor(value):
+    try:
+        raw = base64.urlsafe_b64decode(value + "=" * (-len(value) % 4)).decode()
+        created_at, _, row_id = raw.partition(",")
+        return datetime.datetime.fromisoformat(created_at), int(row_id)
+    except ValueError:
+        abort(400, description="Invalid cursor in after=")
+
+
+def _parse_date_time(date_name, time_name, default_time):
+    """created_at bound from ?<date_name>=YYYY-MM-DD&<time_name>=HH:MM:SS."""
+    date_value = request.args.get(date_name)
+    time_value = request.args.get(time_name)
+    if not date_value and not time_value:
+        return None
+    try:
+        # today's date fallback if user only gives time
+        day = (
+            datetime.date.fromisoformat(date_value) if date_value
+            else datetime.datetime.utcnow().date()
+        )
+        at = datetime.time.fromisoformat(time_value) if time_value else default_time
+    except ValueError:
+        abort(400, description=f"{date_name} must be YYYY-MM-DD and {time_name} HH:MM:SS")
+    return datetime.datetime.combine(day, at)
+
+
+def _parse_int(name, default, minimum, maximum=None):
+    value = request.args.get(name)
+    if not value:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        abort(400, description=f"{name} must be an integer")
+    if number < minimum or (maximum is not None and number > maximum):
+        abort(400, description=f"{name} must be between {minimum} and {maximum or 'any'}")
+    return number
+
+
 @app.route("/db/raw", methods=["GET"])
 def db_list_raw():
     """
@@ -151,115 +172,104 @@ def db_list_raw():
       - start_time=HH:MM:SS
       - end_date=YYYY-MM-DD
       - end_time=HH:MM:SS
-      - limit=<int> (default 50 if no filters; else 100)
-      - offset=<int>
+      - limit=<int> (default 50 if no filters; else 100; at most 1000)
+      - after=<cursor>: the page after the one that returned this cursor
+      - offset=<int> (deprecated: gets slower the deeper it goes, use after=)
+
+    Newest first. When there may be more rows, the response carries an
+    X-Next-Cursor header to pass back as after= for the next page.
 
     If no params → return latest 50 rows.
     """
 
     # ----------- Read query parameters -----------
     route_groups = request.args.getlist("route_group")
+    after = request.args.get("after")
 
-    start_date = request.args.get("start_date")  # "2025-12-02"
-    start_time = request.args.get("start_time")  # "04:49:16"
-
-    end_date = request.args.get("end_date")
-    end_time = request.args.get("end_time")
-
-    limit_param = request.args.get("limit")
-    offset_param = request.args.get("offset")
-
-    # ----------- Detect no filters -----------
-    no_filters = (
-        not route_groups
-        and not start_date and not start_time
-        and not end_date and not end_time
-        and not limit_param and not offset_param
-    )
-
-    if no_filters:
-        limit = 50
-        offset = 0
-    else:
-        limit = int(limit_param) if limit_param else 100
-        offset = int(offset_param) if offset_param else 0
+    # Page size from the filters alone, so following after= (or paging with
+    # offset=) keeps the size of the first page.
+    filters = ("route_group", "start_date", "start_time", "end_date", "end_time")
+    default_limit = 100 if any(request.args.get(name) for name in filters) else 50
+    limit = _parse_int("limit", default_limit, 1, MAX_LIST_LIMIT)
+    offset = _parse_int("offset", 0, 0)
+    if after and offset:
+        abort(400, description="Use either after= or offset=, not both")
 
     # ----------- Build WHERE clause -----------
     where_clauses = []
     params: list = []
 
-    # route_group filter
-    if route_groups:
+    # route_group filter (a single group as "=", so the planner can walk
+    # raw_group_created_idx in order instead of sorting)
+    if len(route_groups) == 1:
+        where_clauses.append("route_group = %s")
+        params.append(route_groups[0])
+    elif route_groups:
         where_clauses.append("route_group = ANY(%s)")
         params.append(route_groups)
 
     # ----------- Build timestamp filters -----------
-    start_ts = None
-    end_ts = None
-
-    # today's date fallback if user only gives time
-    today = datetime.datetime.utcnow().date()
-
-    if start_date or start_time:
-        sd = start_date if start_date else today.isoformat()
-        st = start_time if start_time else "00:00:00"
-        start_ts = f"{sd} {st}"
-
-    if end_date or end_time:
-        ed = end_date if end_date else today.isoformat()
-        et = end_time if end_time else "23:59:59"
-        end_ts = f"{ed} {et}"
-
-    if start_ts and end_ts:
-        where_clauses.append("created_at BETWEEN %s AND %s")
-        params.extend([start_ts, end_ts])
-    elif start_ts:
+    start_ts = _parse_date_time("start_date", "start_time", datetime.time.min)
+    end_ts = _parse_date_time("end_date", "end_time", datetime.time(23, 59, 59))
+
+    if start_ts:
         where_clauses.append("created_at >= %s")
         params.append(start_ts)
-    elif end_ts:
+    if end_ts:
         where_clauses.append("created_at <= %s")
         params.append(end_ts)
 
+    if after:
+        where_clauses.append("(created_at, id) < (%s, %s)")
+        params.extend(_decode_cursor(after))
+
     # ----------- SQL assembly -----------
+    # Index-only scan on raw_group_created_idx / raw_created_idx
+    # (migrations/004_raw_listing_index.sql): size_bytes is a stored column,
+    # so the blob itself is never read.
     sql = """
         SELECT
             id,
             route_group,
             created_at,
-            octet_length(data) AS size_bytes
+            {size_bytes}
         FROM raw
     """
 
     if where_clauses:
         sql += " WHERE " + " AND ".join(where_clauses)
 
-    sql += " ORDER BY created_at DESC LIMIT %s OFFSET %s"
-    params.extend([limit, offset])
+    sql += " ORDER BY created_at DESC, id DESC LIMIT %s"
+    params.append(limit)
+    if offset:
+        sql += " OFFSET %s"
+        params.append(offset)
 
     # ----------- Execute query -----------
     conn = get_db()
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(sql, tuple(params))
+        cur.execute(sql.format(**snapshot_store.raw_columns(conn)), tuple(params))
         rows = cur.fetchall()
-
-        # Reformat created_at to match Neon UI
-        cleaned = []
-        for r in rows:
-            dt = r["created_at"]
-            cleaned.append({
-                "id": r["id"],
-                "route_group": r["route_group"],
-                "created_at": dt.strftime("%a, %d %b %Y %H:%M:%S GMT"),
-                "size_bytes": r["size_bytes"],
-            })
-
-        return jsonify(cleaned)
-
     finally:
-        conn.close()
-
-
+        put_db(conn)
+
+    # Reformat created_at to match Neon UI
+    cleaned = []
+    for r in rows:
+        dt = r["created_at"]
+        cleaned.append({
+            "id": r["id"],
+            "route_group": r["route_group"],
+            "created_at": dt.strftime("%a, %d %b %Y %H:%M:%S GMT"),
+            "size_bytes": r["size_bytes"],
+        })
+
+    resp = jsonify(cleaned)
+    if len(rows) == limit:
+        last = rows[-1]
+        resp.headers["X-Next-Cursor"] = _encode_cursor(last["created_at"], last["id"])
+    return resp
 
 
 @app.route("/db/raw/<int:row_id>/protobuf_raw", methods=["GET"])
@@ -270,24 +280,157 @@ def db_get_raw_protobuf(row_id):
     Response:
       - Content-Type: application/octet-stream
       - Body: raw protobuf (FeedMessage serialized bytes)
+
+    Clients that send Accept-Encoding: gzip get full gzip rows exactly as
+    stored, with Content-Encoding: gzip. Everything else is decompressed
+    in chunks while it is sent; delta rows are rebuilt from their keyframe
+    first (snapshot_store.py). Recently read rows come from an LRU.
     """
     conn = get_db()
     try:
-        cur = conn.cursor()
-        cur.execute("SELECT data FROM raw WHERE id = %s;", (row_id,))
-        row = cur.fetchone()
-        if not row:
-            abort(404, description="Row not found")
+        stored = snapshot_store.load_stored(conn, row_id)
+    finally:
+        put_db(conn)
+    if stored is None:
+        abort(404, description="Row not found")
+
+    codec, dictionary, payload = stored
+    if codec is None:
+        resp = Response(payload, mimetype="application/octet-stream")
+    elif codec == "gzip" and request.accept_encodings["gzip"]:
+        resp = Response(payload, mimetype="application/octet-stream")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(
+            blob_codecs.decompress_stream(payload, codec, dictionary),
+            mimetype="application/octet-stream",
+        )
+    resp.vary.add("Accept-Encoding")
+    return resp
+
+
+@app.route("/db/raw/export", methods=["GET"])
+def db_raw_export():
+    """
+    Every snapshot of one route group in a time range, as one download
+    (see snapshot_export.py).
 
-        compressed = bytes(row[0])        # BYTEA -> bytes
-        decompressed = gzip.decompress(compressed)
+    Query params:
+      - route_group=<str> (required)
+      - start=<ISO timestamp> (required), end=<ISO timestamp> (default: now),
+        compared against created_at (UTC, like /db/raw)
+      - format=delimited|tar (default delimited)
+      - compress=gzip|zstd|lz4: compress each snapshot on its own
+    """
+    route_group = request.args.get("route_group")
+    if not route_group:
+        abort(400, description="route_group is required")
+    start = _parse_timestamp("start")
+    end = _parse_timestamp("end", datetime.datetime.utcnow())
+
+    fmt = request.args.get("format", "delimited")
+    if fmt not in snapshot_export.FORMATS:
+        abort(400, description=f"format must be one of {', '.join(snapshot_export.FORMATS)}")
+    codec = request.args.get("compress") or None
+    if codec and codec not in blob_codecs.CODECS:
+        abort(400, description=f"compress must be one of {', '.join(blob_codecs.CODECS)}")
 
-        return Response(
-            decompressed,
-            mimetype="application/octet-stream"
+    conn = get_db()
+    try:
+        chunks = snapshot_export.export(conn, fmt, route_group, start, end, codec)
+        name = snapshot_export.filename(fmt, route_group, codec)
+        resp = Response(
+            chunks,
+            mimetype=snapshot_export.MIMETYPES[fmt],
+            headers={"Content-Disposition": f'attachment; filename="{name}"'},
         )
+    except Exception:
+        put_db(conn)
+        raise
+    # Held for the whole export; returned when the response is closed, which
+    # also happens for HEAD requests and clients that never read the body.
+    resp.call_on_close(lambda: put_db(conn))
+    return resp
+
+
+@app.route("/db/raw/cache/stats")
+def db_raw_cache_stats():
+    """Row LRU counters for /db/raw/<id>/protobuf_raw (see snapshot_store.py)."""
+    return jsonify(snapshot_store.row_cache_stats())
+
+
+@app.route("/db/raw/<int:row_id>/arrivals", methods=["GET"])
+def db_get_raw_arrivals(row_id):
+    """
+    Arrivals in one stored snapshot.
+
+    Query params:
+      - route_id=<str> (optional)
+      - stop_id=<str> (can appear multiple times)
+    """
+    route_id = request.args.get("route_id")
+    stop_filter = request.args.getlist("stop_id")
+
+    conn = get_db()
+    try:
+        blob = snapshot_store.load_snapshot(conn, row_id)
+        if blob is None:
+            abort(404, description="Row not found")
     finally:
-        conn.close()
+        put_db(conn)
+
+    _, arrivals = history.snapshot_arrivals(blob, route_id, stop_filter)
+    return jsonify(arrivals)
+
+
+def _parse_timestamp(name, default=None):
+    value = request.args.get(name)
+    if not value:
+        if default is None:
+            abort(400, description=f"{name} is required")
+        return default
+    try:
+        return datetime.datetime.fromisoformat(value)
+    except ValueError:
+        abort(400, description=f"{name} must be an ISO timestamp, e.g. 2025-12-02T08:00:00")
+
+
+@app.route("/db/arrivals", methods=["GET"])
+def db_arrivals():
+    """
+    Historical arrivals decoded from every snapshot stored in a time range,
+    streamed as NDJSON (one arrival per line, oldest snapshot first).
+
+    Query params:
+      - route_id=<str> (required)
+      - stop_id=<str> (can appear multiple times)
+      - start=<ISO timestamp> (required), end=<ISO timestamp> (default: now),
+        compared against created_at (UTC, like /db/raw)
+    """
+    route_id = request.args.get("route_id")
+    url = build_feed_url(route_id) if route_id else None
+    if not url:
+        abort(400, description="Invalid route_id")
+
+    stop_filter = request.args.getlist("stop_id")
+    start = _parse_timestamp("start")
+    end = _parse_timestamp("end", datetime.datetime.utcnow())
+
+    conn = get_db()
+    chunks = history.stream_arrivals(
+        conn, feed_cache.feed_name(url), start, end, route_id, stop_filter
+    )
+    resp = Response(chunks, mimetype="application/x-ndjson")
+    # Held for the whole stream; returned when the response is closed, which
+    # also happens for HEAD requests and clients that never read the body.
+    resp.call_on_close(lambda: put_db(conn))
+    return resp
+
+
+@app.route("/db/pool/stats")
+def db_pool_stats():
+    """Connection pool counters (see db_pool.py)."""
+    return jsonify(_DB_POOL.stats())
 
 
 # ----------------------------
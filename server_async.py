@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+"""
+Asyncio (ASGI) serving mode for the realtime endpoints.
+
+Same URL contract as server.py / serverAPI.py:
+  - /route/<route_id>/feed
+  - /route/<route_id>/arrivals?stop_id=...[&enrich=1]
+  - /route/<route_id>/arrivals/stream?stop_id=...  (SSE, see arrivals_stream.py)
+  - /cache/stats
+
+Feeds are downloaded by one refresher task per feed URL over a single pooled
+httpx.AsyncClient, so a slow MTA response never holds up a request: handlers
+only await the in-memory copy. Parsing and index building (see feed_cache.py)
+run in a worker thread to keep the event loop free.
+
+Run with:
+    pip install quart httpx hypercorn
+    hypercorn server_async:app --bind 0.0.0.0:8080
+"""
+import asyncio
+import datetime
+import time
+
+import httpx
+from quart import Quart, Response, abort, jsonify, request
+
+import feed_cache
+import arrivals_stream
+import arrivals_enrich
+from feed_cache import build_feed_url, feed_name
+
+app = Quart(__name__)
+
+# ----------------------------
+#  Feed state (event loop only, no locks needed)
+# ----------------------------
+_FEEDS = {}       # url -> feed_cache entry
+_IN_FLIGHT = {}   # url -> asyncio.Task doing the download + parse
+_REFRESHERS = {}  # url -> asyncio.Task running _refresh_loop
+_UPDATED = {}     # url -> asyncio.Event, set (and replaced) on each new version
+
+_STATS = {"fetches": 0, "coalesced": 0, "fetch_errors": 0}
+
+_client = None
+
+
+@app.before_serving
+async def _open_client():
+    global _client
+    # Static stop / trip / route details for ?enrich=1, built once up front.
+    await asyncio.to_thread(arrivals_enrich.load)
+    _client = httpx.AsyncClient(
+        timeout=feed_cache.FETCH_TIMEOUT,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10),
+    )
+
+
+@app.after_serving
+async def _close_client():
+    for task in _REFRESHERS.values():
+        task.cancel()
+    await asyncio.gather(*_REFRESHERS.values(), return_exceptions=True)
+    await _client.aclose()
+
+
+async def _download(url):
+    try:
+        if feed_cache.replay() is not None:
+            # Recorded snapshots (feed_replay.py) instead of the MTA.
+            blob = await asyncio.to_thread(feed_cache.download_feed, url)
+        else:
+            resp = await _client.get(url)
+            resp.raise_for_status()
+            blob = resp.content
+        entry = await asyncio.to_thread(feed_cache.parse_feed, blob)
+    except Exception:
+        _STATS["fetch_errors"] += 1
+        raise
+
+    previous = _FEEDS.get(url)
+    _FEEDS[url] = entry
+    if previous is None or previous["version"] != entry["version"]:
+        _UPDATED.pop(url, asyncio.Event()).set()
+    return entry
+
+
+def _forget(url, task):
+    _IN_FLIGHT.pop(url, None)
+    if not task.cancelled():
+        task.exception()  # mark retrieved; waiters already re-raised it
+
+
+async def _fetch(url):
+    """Single-flight fetch: concurrent callers await the same task."""
+    task = _IN_FLIGHT.get(url)
+    if task is None:
+        task = asyncio.create_task(_download(url))
+        task.add_done_callback(lambda t: _forget(url, t))
+        _IN_FLIGHT[url] = task
+        _STATS["fetches"] += 1
+    else:
+        _STATS["coalesced"] += 1
+
+    # shield(): a client disconnecting must not cancel everyone's fetch.
+    return await asyncio.shield(task)
+
+
+async def _refresh_loop(url):
+    loop = asyncio.get_running_loop()
+    next_run = loop.time()
+    while True:
+        try:
+            await _fetch(url)
+        except Exception as e:
+            print(f"[server_async] refresh failed for {url}: {e}")
+
+        next_run += feed_cache.MIN_REFRESH_INTERVAL
+        delay = next_run - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        else:
+            next_run = loop.time()
+
+
+async def get_entry(url):
+    """Latest cache entry for `url`; only the first call waits on the network."""
+    if url not in _REFRESHERS:
+        _REFRESHERS[url] = asyncio.create_task(_refresh_loop(url))
+
+    entry = _FEEDS.get(url)
+    if entry is not None:
+        return entry
+    return await _fetch(url)
+
+
+# ----------------------------
+#  Endpoints
+# ----------------------------
+@app.route("/route/<route_id>/feed")
+async def route_feed(route_id):
+    url = build_feed_url(route_id)
+    if not url:
+        abort(400, "Invalid route_id")
+    entry = await get_entry(url)
+    return await asyncio.to_thread(str, entry["feed"])
+
+
+@app.route("/route/<route_id>/arrivals")
+async def route_arrivals(route_id):
+    url = build_feed_url(route_id)
+    if not url:
+        abort(400, "Invalid route_id")
+
+    entry = await get_entry(url)
+    stop_filter = request.args.getlist("stop_id")
+    enrich = request.args.get("enrich") in ("1", "true")
+    body, version = feed_cache.arrivals_json(entry, route_id, stop_filter, enrich)
+
+    resp = Response(body, mimetype="application/json")
+    resp.set_etag(str(version))
+    resp.last_modified = datetime.datetime.fromtimestamp(
+        version, datetime.timezone.utc
+    )
+    return await resp.make_conditional(request)
+
+
+@app.route("/route/<route_id>/arrivals/stream")
+async def route_arrivals_stream(route_id):
+    url = build_feed_url(route_id)
+    if not url:
+        abort(400, "Invalid route_id")
+
+    entry = await get_entry(url)
+    stop_filter = request.args.getlist("stop_id")
+
+    async def events():
+        nonlocal entry
+        loop = asyncio.get_running_loop()
+        yield arrivals_stream.snapshot_event(entry, route_id, stop_filter)
+        last_sent = loop.time()
+        while True:
+            updated = _UPDATED.setdefault(url, asyncio.Event())
+            if _FEEDS[url]["version"] == entry["version"]:
+                wait = arrivals_stream.PING_INTERVAL - (loop.time() - last_sent)
+                try:
+                    await asyncio.wait_for(updated.wait(), max(wait, 0))
+                except asyncio.TimeoutError:
+                    pass
+
+            latest = _FEEDS[url]
+            if latest["version"] != entry["version"]:
+                event = arrivals_stream.diff_event(entry, latest, route_id, stop_filter)
+                entry = latest
+                if event is not None:
+                    yield event
+                    last_sent = loop.time()
+                    continue
+
+            # Ping after PING_INTERVAL without an event, including when the
+            # feed changes but not for these stops.
+            if loop.time() - last_sent >= arrivals_stream.PING_INTERVAL:
+                yield arrivals_stream.PING
+                last_sent = loop.time()
+
+    resp = Response(
+        events(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    resp.timeout = None  # long-lived: no Quart response timeout
+    return resp
+
+
+@app.route("/cache/stats")
+async def cache_stats():
+    now = time.time()
+    result = dict(_STATS)
+    result["in_flight"] = len(_IN_FLIGHT)
+    result["feeds"] = {
+        feed_name(url): round(now - entry["ts"], 1) for url, entry in _FEEDS.items()
+    }
+    if feed_cache.replay() is not None:
+        result["replay"] = feed_cache.replay().stats()
+    return jsonify(result)
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=8080)
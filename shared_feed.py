@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+"""
+Cross-process copy of the raw feed bytes for multi-worker deployments
+(e.g. `gunicorn -w 4 serverAPI:app`).
+
+Each feed (named by feed_cache.feed_name) gets one file in FEED_SHARED_DIR
+(put it on tmpfs, e.g. /dev/shm/product-studio-feeds):
+
+    <name>.feed   32-byte header + raw protobuf bytes
+    <name>.lock   flock()ed by the single worker on this host that fetches
+
+Header layout (little endian): magic "GTFSRT01", stamp (u64, bumped only when
+the bytes change), fetched_at (f64 epoch seconds), payload length (u64).
+
+The fetcher writes a new file and os.replace()s it into place, so readers
+always see a complete snapshot. Readers mmap the file and hand a memoryview
+straight to the protobuf parser (no copy), and only do that when the stamp
+differs from the one they last parsed.
+"""
+import os
+import mmap
+import time
+import fcntl
+import struct
+
+_HEADER = struct.Struct("<8sQdQ")
+_MAGIC = b"GTFSRT01"
+
+# feed name -> open lock file descriptor while this process is the fetcher
+_LOCKS = {}
+
+
+def _path(shared_dir, name, ext):
+    return os.path.join(shared_dir, f"{name}.{ext}")
+
+
+def try_lead(shared_dir, name):
+    """
+    Become (or stay) the fetcher for feed `name` on this host. Non-blocking;
+    the lock is held until the process exits, then another worker takes over.
+    """
+    if name in _LOCKS:
+        return True
+
+    os.makedirs(shared_dir, exist_ok=True)
+    fd = os.open(_path(shared_dir, name, "lock"), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        os.close(fd)
+        return False
+
+    _LOCKS[name] = fd
+    return True
+
+
+def read_header(shared_dir, name):
+    """(stamp, fetched_at, length) of the published copy, or None."""
+    try:
+        with open(_path(shared_dir, name, "feed"), "rb") as f:
+            raw = f.read(_HEADER.size)
+    except FileNotFoundError:
+        return None
+
+    if len(raw) < _HEADER.size:
+        return None
+    magic, stamp, fetched_at, length = _HEADER.unpack(raw)
+    if magic != _MAGIC:
+        return None
+    return stamp, fetched_at, length
+
+
+def attach(shared_dir, name):
+    """
+    Map the published copy. Returns (stamp, fetched_at, mmap, memoryview of
+    the payload) or None if nothing has been published yet. The mapping stays
+    valid after a newer copy replaces the file.
+    """
+    try:
+        f = open(_path(shared_dir, name, "feed"), "rb")
+    except FileNotFoundError:
+        return None
+
+    with f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    magic, stamp, fetched_at, length = _HEADER.unpack_from(mm)
+    if magic != _MAGIC:
+        mm.close()
+        return None
+    return stamp, fetched_at, mm, memoryview(mm)[_HEADER.size:_HEADER.size + length]
+
+
+def publish(shared_dir, name, blob):
+    """Write `blob` as the new shared copy. Only the fetcher calls this."""
+    header = read_header(shared_dir, name)
+    stamp = 1
+    if header is not None:
+        stamp = header[0]
+        current = attach(shared_dir, name)
+        if current is None or current[3] != blob:
+            stamp += 1
+        if current is not None:
+            current[3].release()
+            current[2].close()
+
+    path = _path(shared_dir, name, "feed")
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, stamp, time.time(), len(blob)))
+        f.write(blob)
+    os.replace(tmp, path)
+    return stamp
@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+"""
+Local, append-only archive of feed snapshots: replay and offline tests
+without Postgres.
+
+Layout of an archive directory:
+
+    segments/000001.seg ...  records, appended in arrival order; a new
+                             segment starts once one passes SEGMENT_BYTES
+    index/<route_group>.idx  one fixed-size entry per record of that group,
+                             in timestamp order
+
+A record is a header, the route group and the (optionally compressed)
+snapshot:
+
+    b"GSA1" codec:u8 0:u8 len(group):u16 len(payload):u32 ts_us:i64 crc32:u32
+    group payload
+
+An index entry is (ts_us:i64, segment:u32, offset:u64, record length:u32).
+Readers mmap the index of a group and binary-search it, so finding a point in
+time costs a few page reads however long the archive is. Records are read
+from mmap'd segments as well.
+
+Timestamps are microseconds since the epoch (UTC) in the files, and epoch
+seconds (float) in the API. Within a group they never go backwards: a
+snapshot stamped earlier than the previous one is stored at the previous
+one's time.
+
+Only one process should append at a time (the ingest); any number can read,
+and see new records as they are appended. A crash between writing a record
+and its index entry leaves the record unindexed; `rebuild` recovers it.
+
+Used by gtfs_ingest.py with RAW_SINK=archive|both (SNAPSHOT_ARCHIVE_DIR), or:
+
+    python3 snapshot_archive.py ls archive
+    python3 snapshot_archive.py add archive ace response.bin
+    python3 snapshot_archive.py import-db archive --route-group ace --start 2025-12-02T00:00
+    python3 snapshot_archive.py rebuild archive
+"""
+import os
+import re
+import mmap
+import time
+import zlib
+import struct
+import datetime
+import argparse
+import threading
+
+import blob_codecs
+
+SEGMENT_BYTES = 256 * 1024 * 1024  # start a new segment file past this size
+ARCHIVE_CODEC = os.environ.get(
+    "ARCHIVE_CODEC", "zstd" if "zstd" in blob_codecs.CODECS else "gzip"
+)
+
+_MAGIC = b"GSA1"
+_RECORD = struct.Struct("<4sBBHIqI")
+_ENTRY = struct.Struct("<qIQI")
+_CODEC_IDS = {"": 0, "gzip": 1, "zstd": 2, "lz4": 3}
+_CODEC_NAMES = {v: k for k, v in _CODEC_IDS.items()}
+_GROUP_RE = re.compile(r"[A-Za-z0-9_.-]+")
+
+
+def _to_us(ts):
+    """Microseconds since the epoch from epoch seconds or a datetime (naive = UTC)."""
+    if isinstance(ts, datetime.datetime):
+        if ts.tzinfo is None:
+            ts = ts.replace(tzinfo=datetime.timezone.utc)
+        ts = ts.timestamp()
+    return int(round(ts * 1_000_000))
+
+
+class SnapshotArchive:
+    """Append snapshots to, and read them back from, the archive at `path`."""
+
+    def __init__(self, path, codec=ARCHIVE_CODEC, segment_bytes=SEGMENT_BYTES):
+        if codec and codec not in blob_codecs.CODECS:
+            raise ValueError(f"Codec {codec!r} is not available")
+        self.path = path
+        self.codec = codec or ""
+        self.segment_bytes = segment_bytes
+
+        self._lock = threading.Lock()
+        self._segment = None       # (number, file) being appended to
+        self._index_files = {}     # group -> index file being appended to
+        self._last_us = {}         # group -> timestamp of its last entry
+        self._index_maps = {}      # group -> mmap of its index
+        self._segment_maps = {}    # number -> mmap of the segment
+
+        os.makedirs(os.path.join(path, "segments"), exist_ok=True)
+        os.makedirs(os.path.join(path, "index"), exist_ok=True)
+
+    def _segment_path(self, number):
+        return os.path.join(self.path, "segments", f"{number:06d}.seg")
+
+    def _index_path(self, group):
+        if not _GROUP_RE.fullmatch(group):
+            raise ValueError(f"Invalid route group {group!r}")
+        return os.path.join(self.path, "index", f"{group}.idx")
+
+    def _segments(self):
+        names = os.listdir(os.path.join(self.path, "segments"))
+        return sorted(int(n[:-4]) for n in names if n.endswith(".seg"))
+
+    # ----------------------------
+    #  Writing
+    # ----------------------------
+    def _open_segment(self, size):
+        if self._segment is not None:
+            number, f = self._segment
+            if f.tell() + size <= self.segment_bytes or f.tell() == 0:
+                return number, f
+            f.close()
+            number += 1
+        else:
+            numbers = self._segments()
+            number = numbers[-1] if numbers else 1
+        f = open(self._segment_path(number), "ab")
+        self._segment = (number, f)
+        return self._open_segment(size)
+
+    def _open_index(self, group):
+        f = self._index_files.get(group)
+        if f is None:
+            path = self._index_path(group)
+            f = open(path, "ab")
+            # Drop a torn last entry left by a crash.
+            size = f.tell()
+            if size % _ENTRY.size:
+                f.truncate(size - size % _ENTRY.size)
+                f.seek(0, os.SEEK_END)
+            if f.tell():
+                with open(path, "rb") as r:
+                    r.seek(f.tell() - _ENTRY.size)
+                    self._last_us[group] = _ENTRY.unpack(r.read(_ENTRY.size))[0]
+            self._index_files[group] = f
+        return f
+
+    def append(self, route_group, blob, ts=None):
+        """Store one snapshot of `route_group` taken at `ts` (default: now)."""
+        payload = blob_codecs.compress(blob, self.codec) if self.codec else bytes(blob)
+        group = route_group.encode()
+        ts_us = _to_us(time.time() if ts is None else ts)
+
+        with self._lock:
+            index = self._open_index(route_group)
+            ts_us = max(ts_us, self._last_us.get(route_group, ts_us))
+
+            header = _RECORD.pack(
+                _MAGIC, _CODEC_IDS[self.codec], 0, len(group), len(payload),
+                ts_us, zlib.crc32(payload),
+            )
+            size = len(header) + len(group) + len(payload)
+            number, segment = self._open_segment(size)
+            offset = segment.tell()
+            segment.write(header)
+            segment.write(group)
+            segment.write(payload)
+            segment.flush()
+
+            index.write(_ENTRY.pack(ts_us, number, offset, size))
+            index.flush()
+            self._last_us[route_group] = ts_us
+
+    # ----------------------------
+    #  Reading
+    # ----------------------------
+    def _index(self, group):
+        """(mmap of the group's index or None, entry count)."""
+        try:
+            size = os.path.getsize(self._index_path(group))
+        except FileNotFoundError:
+            return None, 0
+        count = size // _ENTRY.size
+        mm = self._index_maps.get(group)
+        if mm is None or len(mm) < count * _ENTRY.size:
+            if count == 0:
+                return None, 0
+            with open(self._index_path(group), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._index_maps[group] = mm
+        return mm, count
+
+    def _segment_map(self, number, end):
+        mm = self._segment_maps.get(number)
+        if mm is None or len(mm) < end:
+            with open(self._segment_path(number), "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._segment_maps[number] = mm
+        return mm
+
+    def _entry(self, mm, pos):
+        return _ENTRY.unpack_from(mm, pos * _ENTRY.size)
+
+    def _bisect(self, mm, count, ts_us):
+        """Position of the first entry with timestamp >= ts_us."""
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if _ENTRY.unpack_from(mm, mid * _ENTRY.size)[0] < ts_us:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def _read_record(self, number, offset, size):
+        mm = self._segment_map(number, offset + size)
+        magic, codec_id, _, group_len, payload_len, ts_us, crc = _RECORD.unpack_from(mm, offset)
+        if magic != _MAGIC:
+            raise ValueError(f"No record at segment {number} offset {offset}")
+        start = offset + _RECORD.size + group_len
+        payload = mm[start:start + payload_len]
+        if zlib.crc32(payload) != crc:
+            raise ValueError(f"Checksum mismatch at segment {number} offset {offset}")
+        codec = _CODEC_NAMES[codec_id]
+        return blob_codecs.decompress(payload, codec) if codec else payload
+
+    def groups(self):
+        names = os.listdir(os.path.join(self.path, "index"))
+        return sorted(n[:-4] for n in names if n.endswith(".idx"))
+
+    def count(self, route_group):
+        return self._index(route_group)[1]
+
+    def time_range(self, route_group):
+        """(first, last) timestamp of `route_group`, or None if empty."""
+        mm, count = self._index(route_group)
+        if not count:
+            return None
+        return self._entry(mm, 0)[0] / 1e6, self._entry(mm, count - 1)[0] / 1e6
+
+    def timestamps(self, route_group):
+        """Timestamps of every snapshot of `route_group`, oldest first."""
+        mm, count = self._index(route_group)
+        return [self._entry(mm, i)[0] / 1e6 for i in range(count)]
+
+    def get(self, route_group, pos):
+        """The `pos`-th snapshot of `route_group` (as in timestamps())."""
+        mm, count = self._index(route_group)
+        if not 0 <= pos < count:
+            raise IndexError(f"{route_group} has {count} snapshots, not {pos + 1}")
+        _, number, offset, size = self._entry(mm, pos)
+        return self._read_record(number, offset, size)
+
+    def at(self, route_group, ts):
+        """(timestamp, snapshot) of the latest snapshot at or before `ts`, or None."""
+        mm, count = self._index(route_group)
+        ts_us = _to_us(ts)
+        pos = self._bisect(mm, count, ts_us + 1) - 1 if count else -1
+        if pos < 0:
+            return None
+        entry_us, number, offset, size = self._entry(mm, pos)
+        return entry_us / 1e6, self._read_record(number, offset, size)
+
+    def read(self, route_group, start=None, end=None):
+        """(timestamp, snapshot) for every snapshot in [start, end), oldest first."""
+        mm, count = self._index(route_group)
+        if not count:
+            return
+        pos = self._bisect(mm, count, _to_us(start)) if start is not None else 0
+        end_pos = self._bisect(mm, count, _to_us(end)) if end is not None else count
+        for i in range(pos, end_pos):
+            ts_us, number, offset, size = self._entry(mm, i)
+            yield ts_us / 1e6, self._read_record(number, offset, size)
+
+    # ----------------------------
+    #  Maintenance
+    # ----------------------------
+    def rebuild_indexes(self):
+        """Rewrite every index from the segments. Returns records indexed per group."""
+        entries = {}
+        for number in self._segments():
+            path = self._segment_path(number)
+            if not os.path.getsize(path):
+                continue
+            with open(path, "rb") as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            offset = 0
+            while offset + _RECORD.size <= len(data):
+                magic, _, _, group_len, payload_len, ts_us, crc = _RECORD.unpack_from(data, offset)
+                size = _RECORD.size + group_len + payload_len
+                start = offset + _RECORD.size
+                payload = data[start + group_len:offset + size]
+                if magic != _MAGIC or len(payload) != payload_len or zlib.crc32(payload) != crc:
+                    print(f"[archive] segment {number}: stopped at damaged record, offset {offset}")
+                    break
+                group = data[start:start + group_len].decode()
+                entries.setdefault(group, []).append((ts_us, number, offset, size))
+                offset += size
+            data.close()
+
+        with self._lock:
+            self.close()
+            for group, group_entries in entries.items():
+                group_entries.sort()
+                path = self._index_path(group)
+                with open(path + ".tmp", "wb") as f:
+                    for entry in group_entries:
+                        f.write(_ENTRY.pack(*entry))
+                os.replace(path + ".tmp", path)
+        return {group: len(e) for group, e in entries.items()}
+
+    def close(self):
+        if self._segment is not None:
+            self._segment[1].close()
+            self._segment = None
+        for f in self._index_files.values():
+            f.close()
+        self._index_files.clear()
+        self._last_us.clear()
+        for mm in list(self._index_maps.values()) + list(self._segment_maps.values()):
+            mm.close()
+        self._index_maps.clear()
+        self._segment_maps.clear()
+
+
+# ----------------------------
+#  CLI
+# ----------------------------
+def _fmt(ts):
+    return datetime.datetime.fromtimestamp(ts, datetime.timezone.utc).isoformat()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local feed snapshot archive")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_ls = sub.add_parser("ls", help="groups, snapshot counts and time ranges")
+    p_ls.add_argument("path")
+
+    p_add = sub.add_parser("add", help="archive captured feed files (e.g. response.bin)")
+    p_add.add_argument("path")
+    p_add.add_argument("route_group")
+    p_add.add_argument("files", nargs="+")
+
+    p_import = sub.add_parser("import-db", help="copy snapshots from the raw table")
+    p_import.add_argument("path")
+    p_import.add_argument("--route-group", required=True)
+    p_import.add_argument("--start", required=True, help="ISO timestamp (UTC, like created_at)")
+    p_import.add_argument("--end", default=None, help="ISO timestamp (default: now)")
+
+    p_rebuild = sub.add_parser("rebuild", help="rebuild the indexes from the segments")
+    p_rebuild.add_argument("path")
+
+    args = parser.parse_args()
+    archive = SnapshotArchive(args.path)
+    try:
+        if args.command == "ls":
+            for group in archive.groups():
+                first, last = archive.time_range(group) or (0, 0)
+                print(f"{group:<10} {archive.count(group):>8} snapshots  {_fmt(first)} .. {_fmt(last)}")
+        elif args.command == "add":
+            for name in args.files:
+                with open(name, "rb") as f:
+                    archive.append(args.route_group, f.read(), os.path.getmtime(name))
+            print(f"Archived {len(args.files)} snapshots")
+        elif args.command == "import-db":
+            import gtfs_ingest
+            import snapshot_export
+
+            start = datetime.datetime.fromisoformat(args.start)
+            end = datetime.datetime.fromisoformat(args.end) if args.end else datetime.datetime.utcnow()
+            conn = gtfs_ingest.get_connection()
+            count = 0
+            try:
+                for _, created_at, blob in snapshot_export.iter_snapshots(
+                    conn, args.route_group, start, end
+                ):
+                    archive.append(args.route_group, blob, created_at)
+                    count += 1
+            finally:
+                conn.close()
+            print(f"Imported {count} snapshots")
+        else:
+            for group, count in sorted(archive.rebuild_indexes().items()):
+                print(f"{group:<10} {count:>8} snapshots indexed")
+    finally:
+        archive.close()
+
+
+if __name__ == "__main__":
+    main()
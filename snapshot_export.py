@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Bulk export of the stored snapshots of one route group over a time range, so
+offline analysis reads one file instead of one /db/raw/<id>/protobuf_raw
+request per snapshot.
+
+Rows come off a single server-side cursor (FETCH_SIZE at a time); delta rows
+are rebuilt on the way (snapshot_store.py), so every exported snapshot is the
+complete FeedMessage as fetched. Two formats:
+
+    delimited  varint(length) + snapshot, repeated: the usual length-delimited
+               protobuf stream (parseDelimitedFrom / read_delimited()).
+               Nothing else in between, so the file can be mmap'd and walked
+               in place.
+    tar        one member per snapshot, <route_group>/<created_at>_<id>.pb,
+               mtime = created_at. Uncompressed tar, so members sit at fixed
+               offsets in the file as well.
+
+With a codec (--compress / ?compress=) each snapshot is compressed on its own
+(blob_codecs.py): delimited records then hold the compressed bytes, tar
+members get .gz / .zst / .lz4.
+
+Served as GET /db/raw/export by serverAPI.py, or straight from the database:
+
+    python3 snapshot_export.py export --route-group ace \
+        --start 2025-12-02T00:00 --end 2025-12-03T00:00 -o ace.pbd
+    python3 snapshot_export.py ls ace.pbd
+"""
+import os
+import io
+import mmap
+import tarfile
+import datetime
+import argparse
+
+import blob_codecs
+import snapshot_store
+
+FORMATS = ("delimited", "tar")
+FETCH_SIZE = 50  # rows per round trip of the named cursor
+
+EXTENSIONS = {"delimited": ".pbd", "tar": ".tar"}
+CODEC_EXTENSIONS = {"gzip": ".gz", "zstd": ".zst", "lz4": ".lz4"}
+MIMETYPES = {"delimited": "application/octet-stream", "tar": "application/x-tar"}
+
+_RANGE_SQL = """
+    SELECT id, created_at, {storage}, {codec}, {codec_dict_id}, data, {base_id}
+    FROM raw
+    WHERE route_group = %s AND created_at >= %s AND created_at < %s
+    ORDER BY id;
+"""
+
+
+# ----------------------------
+#  Reading rows
+# ----------------------------
+def iter_snapshots(conn, route_group, start, end):
+    """
+    (id, created_at, snapshot bytes) for every `route_group` row stored in
+    [start, end), oldest first. `conn` stays with the caller.
+    """
+    prev_id, blob = None, None
+    with conn.cursor(name="snapshot_export") as cur:
+        cur.itersize = FETCH_SIZE
+        cur.execute(
+            _RANGE_SQL.format(**snapshot_store.raw_columns(conn)),
+            (route_group, start, end),
+        )
+
+        for row_id, created_at, storage, codec, dict_id, data, base_id in cur:
+            payload = blob_codecs.decompress_row(conn, data, codec, dict_id)
+            if storage == "delta":
+                if prev_id != base_id:
+                    # Range starts mid-chain: rebuild the base from its keyframe.
+                    blob = snapshot_store.load_snapshot(conn, base_id)
+                blob = snapshot_store.apply_delta(blob, payload)
+            else:
+                blob = payload
+            prev_id = row_id
+            yield row_id, created_at, blob
+
+
+# ----------------------------
+#  Formats
+# ----------------------------
+def _delimited_chunks(snapshots, codec):
+    for _, _, blob in snapshots:
+        if codec:
+            blob = blob_codecs.compress(blob, codec)
+        header = bytearray()
+        snapshot_store._write_varint(header, len(blob))
+        yield bytes(header)
+        yield blob
+
+
+class _Sink:
+    """Write-only file object that tarfile streams into; drained after each member."""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def _tar_chunks(snapshots, route_group, codec):
+    sink = _Sink()
+    suffix = ".pb" + CODEC_EXTENSIONS.get(codec, "")
+    with tarfile.open(fileobj=sink, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+        for row_id, created_at, blob in snapshots:
+            if codec:
+                blob = blob_codecs.compress(blob, codec)
+            info = tarfile.TarInfo(
+                f"{route_group}/{created_at:%Y%m%dT%H%M%S}_{row_id}{suffix}"
+            )
+            info.size = len(blob)
+            if created_at.tzinfo is None:  # timestamp column: stored as UTC
+                created_at = created_at.replace(tzinfo=datetime.timezone.utc)
+            info.mtime = created_at.timestamp()
+            tar.addfile(info, io.BytesIO(blob))
+            yield sink.drain()
+    yield sink.drain()
+
+
+def export(conn, fmt, route_group, start, end, codec=None):
+    """Bytes chunks of the `fmt` export of `route_group` in [start, end)."""
+    if fmt not in FORMATS:
+        raise ValueError(f"Unknown export format {fmt!r} (one of {', '.join(FORMATS)})")
+    if codec:
+        blob_codecs.compress(b"", codec)  # fail before the first row if unavailable
+
+    snapshots = iter_snapshots(conn, route_group, start, end)
+    if fmt == "tar":
+        return _tar_chunks(snapshots, route_group, codec)
+    return _delimited_chunks(snapshots, codec)
+
+
+def filename(fmt, route_group, codec=None):
+    if fmt == "delimited" and codec:
+        return f"{route_group}{EXTENSIONS[fmt]}{CODEC_EXTENSIONS[codec]}"
+    return f"{route_group}{EXTENSIONS[fmt]}"
+
+
+# ----------------------------
+#  Offline reading
+# ----------------------------
+def read_delimited(path):
+    """
+    Records of a delimited export as memoryviews into an mmap of the file,
+    without copying. Each view is only valid until the next one is taken.
+    """
+    if os.path.getsize(path) == 0:
+        return
+    with open(path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        view = memoryview(mm)
+        try:
+            pos = 0
+            while pos < len(view):
+                length, pos = snapshot_store._read_varint(view, pos)
+                record = view[pos:pos + length]
+                try:
+                    yield record
+                finally:
+                    record.release()
+                pos += length
+        finally:
+            view.release()
+
+
+# ----------------------------
+#  CLI
+# ----------------------------
+def _export_to_file(args):
+    import gtfs_ingest
+
+    start = datetime.datetime.fromisoformat(args.start)
+    end = datetime.datetime.fromisoformat(args.end) if args.end else datetime.datetime.utcnow()
+    output = args.output or filename(args.format, args.route_group, args.compress)
+
+    conn = gtfs_ingest.get_connection()
+    size = 0
+    try:
+        with open(output, "wb") as f:
+            for chunk in export(conn, args.format, args.route_group, start, end, args.compress):
+                f.write(chunk)
+                size += len(chunk)
+    finally:
+        conn.close()
+    print(f"Wrote {size / 1e6:.2f} MB to {output}")
+
+
+def _list_file(args):
+    from google.transit import gtfs_realtime_pb2 as gtfs
+
+    count = 0
+    for record in read_delimited(args.path):
+        blob = blob_codecs.decompress(record, args.compress) if args.compress else record
+        feed = gtfs.FeedMessage()
+        feed.ParseFromString(blob)
+        print(f"{count:>6} {len(record):>9} bytes  feed ts {feed.header.timestamp}  "
+              f"{len(feed.entity)} entities")
+        count += 1
+    print(f"{count} snapshots")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export stored feed snapshots")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_export = sub.add_parser("export", help="export a route group's snapshots to a file")
+    p_export.add_argument("--route-group", required=True)
+    p_export.add_argument("--start", required=True, help="ISO timestamp (UTC, like created_at)")
+    p_export.add_argument("--end", default=None, help="ISO timestamp (default: now)")
+    p_export.add_argument("--format", default="delimited", choices=FORMATS)
+    p_export.add_argument("--compress", default=None, choices=sorted(blob_codecs.CODECS))
+    p_export.add_argument("-o", "--output", default=None)
+
+    p_ls = sub.add_parser("ls", help="list the snapshots in a delimited export")
+    p_ls.add_argument("path")
+    p_ls.add_argument("--compress", default=None, choices=sorted(blob_codecs.CODECS),
+                      help="codec the export was written with")
+
+    args = parser.parse_args()
+    if args.command == "export":
+        _export_to_file(args)
+    else:
+        _list_file(args)
+
+
+if __name__ == "__main__":
+    main()
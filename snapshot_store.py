@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+Keyframe + delta storage for feed snapshots in the `raw` table.
+
+Consecutive snapshots of the same route group are mostly identical: most
+FeedEntity messages (one per trip update / vehicle) come back byte for byte.
+In delta mode the ingest stores a full snapshot (storage = 'full') every
+KEYFRAME_INTERVAL rows per group, and in between only a delta against the
+previous stored row (storage = 'delta', base_id = that row).
+
+A delta works on the top-level protobuf fields of the FeedMessage (the header
+and each entity), taken as raw bytes straight off the wire:
+
+    b"GTD1" varint(field count) op*
+    op = varint(i << 1)             copy field i of the base snapshot
+       | varint(n << 1 | 1) bytes   n new bytes
+
+Because the fields are copied verbatim, rebuilding a snapshot gives back the
+exact bytes that were fetched, which /db/raw/<id>/protobuf_raw relies on.
+
+Each row's payload (snapshot or delta) is compressed with that row's codec
+(blob_codecs.py).
+
+load_stored() keeps the last rows it read in an LRU of up to
+RAW_ROW_CACHE_MB megabytes: replay tools fetch the same snapshots over and
+over, and stored rows never change meaning (recompress_raw.py swaps codec
+and data together, and a cached pair still decodes to the same bytes).
+
+The columns come from migrations/001_raw_delta_storage.sql (storage,
+base_id) and 002_raw_codecs.sql (codec, codec_dict_id). On a table without
+them, raw_columns() reads every row as what it then is, a full gzip
+snapshot; writing deltas or other codecs does need the migrations.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+import blob_codecs
+
+KEYFRAME_INTERVAL = 20  # rows per group between full snapshots
+MAX_CHAIN = 1000        # guard against a broken base_id cycle
+ROW_CACHE_BYTES = int(os.environ.get("RAW_ROW_CACHE_MB", "64")) * 1024 * 1024
+
+_MAGIC = b"GTD1"
+
+
+# ----------------------------
+#  Wire format helpers
+# ----------------------------
+def _read_varint(buf, pos):
+    result = 0
+    shift = 0
+    while True:
+        byte = buf[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return result, pos
+        shift += 7
+
+
+def _write_varint(out, value):
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def split_fields(blob):
+    """Top-level protobuf fields of `blob` as memoryview slices, in order."""
+    view = memoryview(blob)
+    fields = []
+    pos = 0
+    while pos < len(view):
+        start = pos
+        tag, pos = _read_varint(view, pos)
+        wire_type = tag & 0x7
+        if wire_type == 0:
+            _, pos = _read_varint(view, pos)
+        elif wire_type == 1:
+            pos += 8
+        elif wire_type == 2:
+            length, pos = _read_varint(view, pos)
+            pos += length
+        elif wire_type == 5:
+            pos += 4
+        else:
+            raise ValueError(f"Unsupported wire type {wire_type} at byte {start}")
+        fields.append(view[start:pos])
+    return fields
+
+
+# ----------------------------
+#  Deltas
+# ----------------------------
+def encode_delta(base_blob, blob):
+    """Delta that rebuilds `blob` from `base_blob`."""
+    positions = {}
+    for i, field in enumerate(split_fields(base_blob)):
+        positions.setdefault(field.tobytes(), i)
+
+    fields = split_fields(blob)
+    out = bytearray(_MAGIC)
+    _write_varint(out, len(fields))
+    for field in fields:
+        i = positions.get(field.tobytes())
+        if i is not None:
+            _write_varint(out, i << 1)
+        else:
+            _write_varint(out, (len(field) << 1) | 1)
+            out += field
+    return bytes(out)
+
+
+def apply_delta(base_blob, delta):
+    """Rebuild the snapshot bytes from `base_blob` and a delta."""
+    if delta[:4] != _MAGIC:
+        raise ValueError("Not a snapshot delta")
+
+    base_fields = split_fields(base_blob)
+    view = memoryview(delta)
+    count, pos = _read_varint(view, 4)
+
+    parts = []
+    for _ in range(count):
+        op, pos = _read_varint(view, pos)
+        if op & 1:
+            length = op >> 1
+            parts.append(view[pos:pos + length])
+            pos += length
+        else:
+            parts.append(base_fields[op >> 1])
+    return b"".join(parts)
+
+
+# ----------------------------
+#  Reader API
+# ----------------------------
+# raw columns added by the migrations -> what every row holds without them.
+_MIGRATED_COLUMNS = {
+    "storage": "'full'",                  # 001
+    "base_id": "NULL::bigint",            # 001
+    "codec": "'gzip'",                    # 002
+    "codec_dict_id": "NULL::integer",     # 002
+    "size_bytes": "octet_length(data)",   # 004
+}
+_RAW_COLUMNS = None
+_RAW_COLUMNS_LOCK = threading.Lock()
+
+
+def raw_columns(conn):
+    """
+    Column name -> select expression for the migrated columns of raw: the
+    column itself, or its pre-migration value under the same name. Looked
+    up once per process.
+    """
+    global _RAW_COLUMNS
+    with _RAW_COLUMNS_LOCK:
+        if _RAW_COLUMNS is None:
+            with conn.cursor() as cur:
+                cur.execute(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name = 'raw' AND table_schema = ANY(current_schemas(false))"
+                )
+                present = {name for (name,) in cur.fetchall()}
+            _RAW_COLUMNS = {
+                name: name if name in present else f"{default} AS {name}"
+                for name, default in _MIGRATED_COLUMNS.items()
+            }
+        return _RAW_COLUMNS
+
+
+_CHAIN_SQL = """
+    WITH RECURSIVE chain AS (
+        SELECT id, {base_id}, {storage}, {codec}, {codec_dict_id}, data, 0 AS depth
+        FROM raw
+        WHERE id = %s
+      UNION ALL
+        SELECT r.id, r.base_id, r.storage, r.codec, r.codec_dict_id, r.data,
+               c.depth + 1
+        FROM raw r
+        JOIN chain c ON r.id = c.base_id
+        WHERE c.storage = 'delta' AND c.depth < %s
+    )
+    SELECT id, storage, codec, codec_dict_id, data FROM chain ORDER BY depth DESC;
+"""
+
+
+def _chain_rows(conn, row_id):
+    """Rows of `row_id`'s chain, keyframe first (see decode_chain)."""
+    columns = raw_columns(conn)
+    with conn.cursor() as cur:
+        if columns["storage"] == "storage":
+            cur.execute(_CHAIN_SQL.format(**columns), (row_id, MAX_CHAIN))
+        else:
+            # No deltas without migrations/001: the row alone is the chain.
+            cur.execute(
+                f"SELECT id, {columns['storage']}, {columns['codec']}, "
+                f"{columns['codec_dict_id']}, data FROM raw WHERE id = %s",
+                (row_id,),
+            )
+        return cur.fetchall()
+
+
+def decode_chain(conn, rows):
+    """
+    Snapshot bytes from (id, storage, codec, codec_dict_id, data) rows
+    ordered keyframe first, as returned by _CHAIN_SQL.
+    """
+    blob = None
+    for row_id, storage, codec, dict_id, data in rows:
+        payload = blob_codecs.decompress_row(conn, data, codec, dict_id)
+        if storage == "delta":
+            if blob is None:
+                raise ValueError(f"Delta row {row_id} has no keyframe")
+            blob = apply_delta(blob, payload)
+        else:
+            blob = payload
+    return blob
+
+
+def load_snapshot(conn, row_id):
+    """Decompressed protobuf bytes of `raw` row `row_id`, or None if missing."""
+    rows = _chain_rows(conn, row_id)
+    if not rows:
+        return None
+    return decode_chain(conn, rows)
+
+
+# ----------------------------
+#  Row cache (/db/raw/<id>/protobuf_raw)
+# ----------------------------
+_ROW_CACHE = OrderedDict()  # row id -> (codec, dictionary, payload)
+_ROW_CACHE_LOCK = threading.Lock()
+_ROW_CACHE_STATS = {"hits": 0, "misses": 0, "bytes": 0}
+
+
+def load_stored(conn, row_id):
+    """
+    (codec, dictionary, payload) for `raw` row `row_id`, or None if missing.
+
+    A full row comes back as stored: `payload` is still compressed with
+    `codec` (and the zstd `dictionary` bytes, if any), so callers can stream
+    its decompression or pass gzip through untouched. A delta row is rebuilt,
+    with codec None and `payload` the snapshot bytes.
+    """
+    with _ROW_CACHE_LOCK:
+        stored = _ROW_CACHE.get(row_id)
+        if stored is not None:
+            _ROW_CACHE.move_to_end(row_id)
+            _ROW_CACHE_STATS["hits"] += 1
+            return stored
+        _ROW_CACHE_STATS["misses"] += 1
+
+    rows = _chain_rows(conn, row_id)
+    if not rows:
+        return None
+
+    _, storage, codec, dict_id, data = rows[-1]
+    if storage == "full":
+        stored = (codec, blob_codecs.load_dictionary(conn, dict_id), bytes(data))
+    else:
+        stored = (None, None, decode_chain(conn, rows))
+
+    size = len(stored[2])
+    if size <= ROW_CACHE_BYTES:
+        with _ROW_CACHE_LOCK:
+            if row_id not in _ROW_CACHE:
+                _ROW_CACHE[row_id] = stored
+                _ROW_CACHE_STATS["bytes"] += size
+            while _ROW_CACHE_STATS["bytes"] > ROW_CACHE_BYTES:
+                _, (_, _, evicted) = _ROW_CACHE.popitem(last=False)
+                _ROW_CACHE_STATS["bytes"] -= len(evicted)
+    return stored
+
+
+def row_cache_stats():
+    with _ROW_CACHE_LOCK:
+        result = dict(_ROW_CACHE_STATS)
+        result["rows"] = len(_ROW_CACHE)
+    result["max_bytes"] = ROW_CACHE_BYTES
+    return result
@@ -0,0 +1,299 @@
+#!/usr/bin/env python3
+"""
+In-process copy of the static GTFS tables (stops, routes, trips, ...), so
+lookups that only change when the MTA publishes a new static GTFS skip
+Postgres.
+
+Enabled with STATIC_GTFS:
+    STATIC_GTFS=files   load gtfs_subway/*.txt (or STATIC_GTFS_DIR)
+    STATIC_GTFS=db      load the tables from Postgres
+    unset               off; iqra-server.py queries Postgres as before
+
+Each table is stored by column: numeric columns without gaps are array()s,
+the rest tuples of (interned) values. Hash indexes map a key value to the
+row positions holding it (see INDEXES). A lookup is a dict get plus building
+the few matching rows.
+
+A refresher thread checks the source every RELOAD_INTERVAL seconds (file
+mtimes, or the tables' OIDs, which change when neondb.py swaps in a new
+load, plus Postgres' insert/update/delete counters for them, which lag
+writes by a few seconds) and, when it changed, builds a new store off to
+the side and swaps it in; readers never see a half-loaded store.
+
+Values loaded from files are typed with COLUMN_TYPES to match what the SQL
+endpoints return; values loaded from the DB are exactly what psycopg2 gives.
+"""
+import os
+import sys
+import csv
+import time
+import datetime
+import threading
+from array import array
+
+SOURCE = os.environ.get("STATIC_GTFS", "")
+GTFS_DIR = os.environ.get(
+    "STATIC_GTFS_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "gtfs_subway")
+)
+RELOAD_INTERVAL = 30  # seconds between checks for a new static GTFS
+
+# table -> indexed columns
+INDEXES = {
+    "agency": ["agency_id"],
+    "calendar": ["service_id"],
+    "calendar_dates": ["service_id"],
+    "routes": ["route_id"],
+    "stops": ["stop_id"],
+    "transfers": ["from_stop_id", "to_stop_id"],
+    "trips": ["trip_id", "route_id", "service_id"],
+    # Only loaded from files that have them (they are large; in the DB they
+    # stay in Postgres).
+    "shapes": ["shape_id"],
+    "stop_times": ["trip_id"],
+}
+DB_TABLES = ["agency", "calendar", "calendar_dates", "routes", "stops", "transfers", "trips"]
+
+# column -> type for values read from .txt files; everything else is text
+COLUMN_TYPES = {
+    "stop_lat": float,
+    "stop_lon": float,
+    "shape_pt_lat": float,
+    "shape_pt_lon": float,
+    "location_type": int,
+    "route_type": int,
+    "route_sort_order": int,
+    "direction_id": int,
+    "exception_type": int,
+    "transfer_type": int,
+    "min_transfer_time": int,
+    "stop_sequence": int,
+    "shape_pt_sequence": int,
+    "monday": int,
+    "tuesday": int,
+    "wednesday": int,
+    "thursday": int,
+    "friday": int,
+    "saturday": int,
+    "sunday": int,
+    "start_date": "date",
+    "end_date": "date",
+    "date": "date",
+}
+
+
+# ----------------------------
+#  Tables
+# ----------------------------
+def _convert(column, value):
+    if value == "" or value is None:
+        return None
+    kind = COLUMN_TYPES.get(column)
+    if kind is None:
+        return sys.intern(value)
+    if kind == "date":
+        return datetime.datetime.strptime(value, "%Y%m%d").date()
+    return kind(value)
+
+
+def _pack(values):
+    """Compact storage for one column."""
+    if values and all(type(v) is int for v in values):
+        return array("q", values)
+    if values and all(type(v) is float for v in values):
+        return array("d", values)
+    return tuple(values)
+
+
+class Table:
+    """Column-oriented rows plus hash indexes on some of the columns."""
+
+    __slots__ = ("name", "columns", "data", "indexes", "size")
+
+    def __init__(self, name, columns, rows, indexed):
+        self.name = name
+        self.columns = tuple(columns)
+        self.size = len(rows)
+        self.data = [_pack([row[i] for row in rows]) for i in range(len(columns))]
+
+        self.indexes = {}
+        for column in indexed:
+            if column not in self.columns:
+                continue
+            index = {}
+            for pos, value in enumerate(self.data[self.columns.index(column)]):
+                index.setdefault(value, array("I")).append(pos)
+            self.indexes[column] = index
+
+    def row(self, pos):
+        return {column: self.data[i][pos] for i, column in enumerate(self.columns)}
+
+    def rows(self):
+        return [self.row(pos) for pos in range(self.size)]
+
+    def lookup(self, column, value):
+        """Rows where `column` == `value`, in source order."""
+        return [self.row(pos) for pos in self.indexes[column].get(value, ())]
+
+
+def _load_file(path, name):
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.reader(f)
+        columns = next(reader)
+        rows = [
+            [_convert(column, value) for column, value in zip(columns, record)]
+            for record in reader
+            if record
+        ]
+    return Table(name, columns, rows, INDEXES[name])
+
+
+def _files_fingerprint(gtfs_dir):
+    fingerprint = []
+    for name in INDEXES:
+        path = os.path.join(gtfs_dir, f"{name}.txt")
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            continue
+        fingerprint.append((name, st.st_mtime_ns, st.st_size))
+    return tuple(fingerprint)
+
+
+def load_from_files(gtfs_dir=GTFS_DIR, tables=None):
+    """The INDEXES tables found in `gtfs_dir`, or only those named in `tables`."""
+    loaded = {}
+    for name in tables or INDEXES:
+        path = os.path.join(gtfs_dir, f"{name}.txt")
+        if os.path.exists(path):
+            loaded[name] = _load_file(path, name)
+    return loaded
+
+
+def _db_fingerprint(conn):
+    with conn.cursor() as cur:
+        cur.execute(
+            """
+            SELECT relname, relid, n_tup_ins, n_tup_upd, n_tup_del
+            FROM pg_stat_user_tables
+            WHERE relname = ANY(%s)
+            ORDER BY relname;
+            """,
+            (DB_TABLES,),
+        )
+        fingerprint = tuple(cur.fetchall())
+    conn.rollback()
+    return fingerprint
+
+
+def load_from_db(conn):
+    tables = {}
+    with conn.cursor() as cur:
+        for name in DB_TABLES:
+            cur.execute(f"SELECT * FROM {name};")
+            columns = [desc[0] for desc in cur.description]
+            rows = [
+                [sys.intern(v) if type(v) is str else v for v in record]
+                for record in cur.fetchall()
+            ]
+            tables[name] = Table(name, columns, rows, INDEXES[name])
+    conn.rollback()
+    return tables
+
+
+# ----------------------------
+#  Store + hot reload
+# ----------------------------
+_STORE = {"tables": {}, "fingerprint": None, "loaded_at": None, "load_ms": None}
+_STORE_LOCK = threading.Lock()
+_REFRESHER = None
+
+
+def _reload(get_conn=None, put_conn=None):
+    """Load from SOURCE if it changed since the last load. Returns True if swapped."""
+    global _STORE
+    start = time.perf_counter()
+    if SOURCE == "files":
+        fingerprint = _files_fingerprint(GTFS_DIR)
+        if fingerprint == _STORE["fingerprint"]:
+            return False
+        tables = load_from_files(GTFS_DIR)
+    else:
+        conn = get_conn()
+        try:
+            fingerprint = _db_fingerprint(conn)
+            if fingerprint == _STORE["fingerprint"]:
+                return False
+            tables = load_from_db(conn)
+        finally:
+            put_conn(conn)
+
+    with _STORE_LOCK:
+        _STORE = {
+            "tables": tables,
+            "fingerprint": fingerprint,
+            "loaded_at": time.time(),
+            "load_ms": round((time.perf_counter() - start) * 1000, 1),
+        }
+    print(
+        f"[static_gtfs] loaded {sum(t.size for t in tables.values())} rows "
+        f"from {SOURCE} in {_STORE['load_ms']} ms"
+    )
+    return True
+
+
+def _refresh_loop(get_conn, put_conn):
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        try:
+            _reload(get_conn, put_conn)
+        except Exception as e:
+            print(f"[static_gtfs] reload failed, keeping the loaded copy: {e}")
+
+
+def start(get_conn=None, put_conn=None):
+    """
+    Load the store (STATIC_GTFS=db needs get_conn/put_conn) and start the
+    hot-reload thread. No-op when STATIC_GTFS is unset.
+    """
+    global _REFRESHER
+    if not SOURCE or _REFRESHER is not None:
+        return
+    if SOURCE not in ("files", "db"):
+        raise ValueError(f"STATIC_GTFS must be 'files' or 'db', not {SOURCE!r}")
+
+    _reload(get_conn, put_conn)
+    _REFRESHER = threading.Thread(
+        target=_refresh_loop, args=(get_conn, put_conn), daemon=True
+    )
+    _REFRESHER.start()
+
+
+def has(table):
+    """True if `table` is served from memory."""
+    return table in _STORE["tables"]
+
+
+def lookup(table, column, value):
+    """Rows of `table` where `column` == `value` (column must be indexed)."""
+    return _STORE["tables"][table].lookup(column, value)
+
+
+def lookup_many(table, column, values):
+    """Rows of `table` where `column` is any of `values`, grouped by value."""
+    t = _STORE["tables"][table]
+    return [row for value in values for row in t.lookup(column, value)]
+
+
+def all_rows(table):
+    """Every row of `table`, in source order."""
+    return _STORE["tables"][table].rows()
+
+
+def stats():
+    store = _STORE
+    return {
+        "source": SOURCE or None,
+        "loaded_at": store["loaded_at"],
+        "load_ms": store["load_ms"],
+        "tables": {name: t.size for name, t in store["tables"].items()},
+    }
@@ -52,6 +52,11 @@ def test_db_list_raw():
     rows = r.json()
     print(f"Got {len(rows)} rows (showing up to 5):")
     pretty(rows[:5])
+
+    cursor = r.headers.get("X-Next-Cursor")
+    if cursor:
+        r = requests.get(url, params={"after": cursor})
+        print(f"Next page (after={cursor}): status {r.status_code}, {len(r.json())} rows")
     return rows
 
 